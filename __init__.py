@@ -1,11 +1,22 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 from trytond.pool import Pool
-from . import sale
+from . import chapter, company, importer, ir, sale, template
 
 
 def register():
     Pool.register(
+        company.Company,
+        ir.Cron,
         sale.Sale,
         sale.SaleLine,
+        chapter.SaleChapter,
+        importer.ImportLinesStart,
+        template.ChapterTemplate,
+        template.ChapterTemplateLine,
+        template.InsertChapterTemplateStart,
         module='sale_subchapters', type_='model')
+    Pool.register(
+        importer.ImportLines,
+        template.InsertChapterTemplate,
+        module='sale_subchapters', type_='wizard')
@@ -0,0 +1,99 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from sql.conditionals import Case, Coalesce
+from sql.functions import DateTrunc
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.modules.currency.fields import Monetary
+from trytond.pool import Pool
+from trytond.pyson import Eval
+
+__all__ = ['SaleChapter']
+
+
+class SaleChapter(ModelSQL, ModelView):
+    '''Sale Chapter
+
+    A read-only record per title and subtitle of all the sales, with the
+    chapter total stored on the line, so the chapters can be searched and
+    aggregated by the database without loading the sale lines.
+    '''
+    __name__ = 'sale.chapter'
+    line = fields.Many2One('sale.line', "Line", readonly=True)
+    sale = fields.Many2One('sale.sale', "Sale", readonly=True)
+    company = fields.Many2One('company.company', "Company", readonly=True)
+    party = fields.Many2One('party.party', "Party", readonly=True,
+        context={
+            'company': Eval('company', -1),
+            },
+        depends={'company'})
+    sale_date = fields.Date("Sale Date", readonly=True)
+    month = fields.Date("Month", readonly=True,
+        help="The first day of the month of the sale date.")
+    state = fields.Selection('get_states', "State", readonly=True)
+    type = fields.Selection([
+            ('title', "Title"),
+            ('subtitle', "Subtitle"),
+            ], "Type", readonly=True)
+    level = fields.Integer("Level", readonly=True)
+    sequence = fields.Integer("Sequence", readonly=True)
+    description = fields.Text("Description", readonly=True)
+    parent = fields.Many2One('sale.chapter', "Parent", readonly=True)
+    children = fields.One2Many('sale.chapter', 'parent', "Children",
+        readonly=True)
+    currency = fields.Many2One('currency.currency', "Currency",
+        readonly=True)
+    total = Monetary("Total", digits='currency', currency='currency',
+        readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(SaleChapter, cls).__setup__()
+        cls._order = [
+            ('sale_date', 'DESC NULLS FIRST'),
+            ('sale', 'DESC'),
+            ('sequence', 'ASC NULLS FIRST'),
+            ('id', 'ASC'),
+            ]
+
+    @classmethod
+    def get_states(cls):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        return Sale.fields_get(['state'])['state']['selection']
+
+    @classmethod
+    def table_query(cls):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        line = SaleLine.__table__()
+        sale = Sale.__table__()
+
+        level = Case((line.type == 'title', 1),
+            else_=Coalesce(line.chapter_level, 2))
+        return line.join(sale, condition=line.sale == sale.id).select(
+            line.id.as_('id'),
+            line.create_uid.as_('create_uid'),
+            line.create_date.as_('create_date'),
+            line.write_uid.as_('write_uid'),
+            line.write_date.as_('write_date'),
+            line.id.as_('line'),
+            sale.id.as_('sale'),
+            sale.company.as_('company'),
+            sale.party.as_('party'),
+            sale.sale_date.as_('sale_date'),
+            cls.month.sql_cast(
+                DateTrunc('month', sale.sale_date)).as_('month'),
+            sale.state.as_('state'),
+            line.type.as_('type'),
+            level.as_('level'),
+            line.sequence.as_('sequence'),
+            line.description.as_('description'),
+            line.chapter.as_('parent'),
+            sale.currency.as_('currency'),
+            line.chapter_amount.as_('total'),
+            where=line.type.in_(['title', 'subtitle']))
+
+    def get_rec_name(self, name):
+        return self.description or str(self.id)
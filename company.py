@@ -0,0 +1,18 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.model import fields
+from trytond.pool import PoolMeta
+
+__all__ = ['Company']
+
+
+class Company(metaclass=PoolMeta):
+    __name__ = 'company.company'
+    sale_subtotals_queue_threshold = fields.Integer(
+        "Queue Subtotals Threshold",
+        help="Update the subtotals of the sales with at least this number of "
+        "lines in the background.\n"
+        "Leave empty to always update them immediately.")
+    sale_subtotals_auto = fields.Boolean("Maintain Subtotals",
+        help="Generate, rename and remove the subtotal lines of the draft "
+        "sales when their titles and subtitles are modified.")
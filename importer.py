@@ -0,0 +1,73 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import csv
+import io
+import json
+
+from trytond.model import ModelView, fields
+from trytond.wizard import Button, StateTransition, StateView, Wizard
+
+__all__ = ['ImportLinesStart', 'ImportLines', 'read_rows']
+
+
+def read_rows(file, format='csv', encoding='utf-8'):
+    '''Yield the rows of a CSV or JSON Lines file as dictionaries
+
+    file may be bytes or a binary or text file object which is read as a
+    stream. The CSV column names are case insensitive.
+    '''
+    if isinstance(file, bytes):
+        file = io.BytesIO(file)
+    if not isinstance(file, io.TextIOBase):
+        file = io.TextIOWrapper(file, encoding=encoding, newline='')
+    if format == 'csv':
+        for row in csv.DictReader(file):
+            yield {(k or '').strip().lower(): v for k, v in row.items()}
+    elif format == 'jsonl':
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        raise ValueError("Unknown format %r" % format)
+
+
+class ImportLinesStart(ModelView):
+    "Import Sale Lines"
+    __name__ = 'sale.import_lines.start'
+    file_ = fields.Binary("File", required=True, filename='filename',
+        help="The CSV or JSON Lines file with a row per line.\n"
+        "The columns are type, level, description, product, quantity and "
+        "unit_price.")
+    filename = fields.Char("File Name")
+    format = fields.Selection([
+            ('csv', "CSV"),
+            ('jsonl', "JSON Lines"),
+            ], "Format", required=True)
+
+    @classmethod
+    def default_format(cls):
+        return 'csv'
+
+    @fields.depends('filename', 'format')
+    def on_change_filename(self):
+        if self.filename:
+            if self.filename.lower().endswith(('.jsonl', '.ndjson')):
+                self.format = 'jsonl'
+            elif self.filename.lower().endswith('.csv'):
+                self.format = 'csv'
+
+
+class ImportLines(Wizard):
+    "Import Sale Lines"
+    __name__ = 'sale.import_lines'
+    start = StateView('sale.import_lines.start',
+        'sale_subchapters.sale_import_lines_start_view_form', [
+            Button("Cancel", 'end', 'tryton-cancel'),
+            Button("Import", 'import_', 'tryton-ok', default=True),
+            ])
+    import_ = StateTransition()
+
+    def transition_import_(self):
+        self.record.import_lines(
+            read_rows(self.start.file_, self.start.format))
+        return 'end'
@@ -0,0 +1,133 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""Optional instrumentation of the subchapter hot paths
+
+It is enabled by the ``instrument`` option of the ``[sale_subchapters]``
+section of the configuration file or by setting the level of the
+``trytond.modules.sale_subchapters.instrument`` logger to DEBUG.
+
+Each instrumented call emits a log record whose ``sale_subchapters``
+attribute holds the measures and adds them to ``counters``, which an
+exporter can scrape.
+"""
+import logging
+import time
+from collections import defaultdict
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['instrument', 'counters']
+
+logger = logging.getLogger(__name__)
+
+MEASURES = ['calls', 'time', 'lines', 'queries', 'created', 'written']
+# Cumulated measures per operation since the process started
+counters = defaultdict(lambda: dict.fromkeys(MEASURES, 0))
+
+
+def enabled():
+    return (logger.isEnabledFor(logging.DEBUG)
+        or config.getboolean('sale_subchapters', 'instrument',
+            default=False))
+
+
+class Stats(object):
+    "Measures of an instrumented call"
+    __slots__ = ('operation', 'enabled', 'lines', 'queries', 'created',
+        'written', 'time', '_start', '_connection')
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.enabled = enabled()
+        self.lines = self.queries = self.created = self.written = 0
+        self.time = 0
+
+    def __enter__(self):
+        if self.enabled:
+            transaction = Transaction()
+            self._connection = transaction.connection
+            transaction.connection = _CountingConnection(
+                self._connection, self)
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if not self.enabled:
+            return
+        self.time = time.perf_counter() - self._start
+        Transaction().connection = self._connection
+        self._connection = None
+        if type is not None:
+            return
+        values = {
+            'operation': self.operation,
+            'time': self.time,
+            'lines': self.lines,
+            'queries': self.queries,
+            'created': self.created,
+            'written': self.written,
+            }
+        counter = counters[self.operation]
+        counter['calls'] += 1
+        for measure in MEASURES[1:]:
+            counter[measure] += values[measure]
+        logger.info(
+            "%(operation)s: %(time).4fs, %(lines)d lines, "
+            "%(queries)d queries, %(created)d created, %(written)d written",
+            values, extra={'sale_subchapters': values})
+
+
+def instrument(operation):
+    """Return a context manager measuring the operation
+
+    The lines, created and written attributes of the returned object must
+    be increased by the instrumented code.
+    """
+    return Stats(operation)
+
+
+class _CountingConnection(object):
+    "Connection proxy counting the SQL statements executed"
+    __slots__ = ('_connection', '_stats')
+
+    def __init__(self, connection, stats):
+        self._connection = connection
+        self._stats = stats
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(
+            self._connection.cursor(*args, **kwargs), self._stats)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+class _CountingCursor(object):
+    "Cursor proxy counting the SQL statements executed"
+    __slots__ = ('_cursor', '_stats')
+
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+
+    def execute(self, *args, **kwargs):
+        self._stats.queries += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._stats.queries += 1
+        return self._cursor.executemany(*args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self._cursor.__exit__(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
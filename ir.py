@@ -0,0 +1,66 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.i18n import gettext
+from trytond.model import ModelView, dualmethod, fields
+from trytond.model.exceptions import ValidationError
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval, PYSONDecoder
+
+__all__ = ['Cron']
+
+_UPDATE_DRAFT_SUBTOTALS = 'sale.sale|update_draft_subtotals'
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+    sale_subtotals_domain = fields.Char("Sales Domain",
+        states={
+            'invisible': Eval('method') != _UPDATE_DRAFT_SUBTOTALS,
+            },
+        help="The PYSON domain of the draft sales to update.\n"
+        "Leave empty to update all the draft sales.")
+
+    @classmethod
+    def __setup__(cls):
+        super(Cron, cls).__setup__()
+        cls.method.selection.append(
+            (_UPDATE_DRAFT_SUBTOTALS, "Update Subtotals of Draft Sales"))
+
+    @classmethod
+    def validate_fields(cls, crons, field_names):
+        super(Cron, cls).validate_fields(crons, field_names)
+        cls.check_sale_subtotals_domain(crons, field_names)
+
+    @classmethod
+    def check_sale_subtotals_domain(cls, crons, field_names=None):
+        if field_names and 'sale_subtotals_domain' not in field_names:
+            return
+        for cron in crons:
+            if not cron.sale_subtotals_domain:
+                continue
+            try:
+                fields.domain_validate(cron.get_sale_subtotals_domain())
+            except Exception as exception:
+                raise ValidationError(gettext(
+                        'sale_subchapters.msg_cron_invalid_sale_domain',
+                        domain=cron.sale_subtotals_domain)) from exception
+
+    def get_sale_subtotals_domain(self):
+        "Return the decoded domain of the sales to update"
+        if self.sale_subtotals_domain:
+            return PYSONDecoder().decode(self.sale_subtotals_domain)
+        return []
+
+    @dualmethod
+    @ModelView.button
+    def run_once(cls, crons):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        others = []
+        for cron in crons:
+            if cron.method == _UPDATE_DRAFT_SUBTOTALS:
+                Sale.update_draft_subtotals(
+                    domain=cron.get_sale_subtotals_domain())
+            else:
+                others.append(cron)
+        super(Cron, cls).run_once(others)
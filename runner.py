@@ -0,0 +1,159 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""Parallel update of the subtotals of many sales
+
+The sales are partitioned across a pool of processes and each sale is
+updated in its own transaction after locking its row, so concurrent runs,
+the cron or users can not restructure the same sale at the same time.
+
+It is used by the ``trytond-sale-subtotals`` script and can be called from
+Python once the configuration is loaded:
+
+    from trytond.modules.sale_subchapters.runner import run
+    run('database', processes=4)
+"""
+import logging
+import multiprocessing
+import time
+from concurrent import futures
+
+from trytond import backend
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction, TransactionError
+
+__all__ = ['run']
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 10
+
+
+def initializer(database_name):
+    "Initialize the pool of the database in the current process"
+    database_list = Pool.database_list()
+    pool = Pool(database_name)
+    if database_name not in database_list:
+        with Transaction().start(database_name, 0, readonly=True):
+            pool.init()
+
+
+def get_sale_ids(database_name, domain=None):
+    "Return the ids of the draft sales matching the domain"
+    pool = Pool(database_name)
+    with Transaction().start(database_name, 0, readonly=True):
+        Sale = pool.get('sale.sale')
+        sales = Sale.search([
+                ('state', '=', 'draft'),
+                ('subtotals_queued', '=', False),
+                domain or [],
+                ], order=[('id', 'ASC')])
+        return [s.id for s in sales]
+
+
+def update_sale(database_name, sale_id):
+    '''Update the subtotals of the sale in a new transaction
+
+    The sale is locked before being processed and the transaction is
+    retried when the lock can not be taken or the database reports a
+    concurrent update. Return the sale id, the number of retries and
+    whether it succeeded.
+    '''
+    pool = Pool(database_name)
+    retry = config.getint('database', 'retry')
+    name = '<Subtotals sale.sale,%s@%s>' % (sale_id, database_name)
+    count = 0
+    transaction_extras = {}
+    while True:
+        if count:
+            time.sleep(0.02 * count)
+        try:
+            with Transaction().start(
+                    database_name, 0, **transaction_extras) as transaction:
+                try:
+                    Sale = pool.get('sale.sale')
+                    sales = Sale.search([('id', '=', sale_id)])
+                    Sale.lock(sales)
+                    # The queue takes care of the sales queued meanwhile
+                    sales = [s for s in sales if not s.subtotals_queued]
+                    Sale._update_subtotals(sales)
+                except TransactionError as e:
+                    transaction.rollback()
+                    e.fix(transaction_extras)
+                    continue
+            return sale_id, count, True
+        except backend.DatabaseOperationalError:
+            if count < retry:
+                count += 1
+                logger.debug("%s retry: %i", name, count)
+                continue
+            logger.warning("%s failed after %i retries", name, count,
+                exc_info=logger.isEnabledFor(logging.DEBUG))
+        except Exception:
+            logger.exception("%s failed", name)
+        return sale_id, count, False
+
+
+def _update_sales(database_name, sale_ids):
+    return [update_sale(database_name, i) for i in sale_ids]
+
+
+def _get_chunks(sale_ids, chunk_size):
+    return [sale_ids[i:i + chunk_size]
+        for i in range(0, len(sale_ids), chunk_size)]
+
+
+def run(database_name, sale_ids=None, processes=1, chunk_size=CHUNK_SIZE):
+    '''Update the subtotals of the sales using processes workers
+
+    sale_ids defaults to the draft sales not queued. They are sent by
+    chunks of chunk_size to the workers. Return a dictionary with the
+    number of sales, updated and retries, the ids of the failed sales, the
+    time spent and the throughput in sales per second.
+
+    With several processes, the current process opens no connection: the
+    workers are forked, as they must inherit the loaded configuration, and
+    they would share its connections otherwise.
+    '''
+    started = time.monotonic()
+    if processes > 1 and sale_ids is not None:
+        processes = min(processes, len(_get_chunks(sale_ids, chunk_size)))
+    if processes > 1:
+        with futures.ProcessPoolExecutor(processes,
+                mp_context=multiprocessing.get_context('fork'),
+                initializer=initializer,
+                initargs=(database_name,)) as executor:
+            if sale_ids is None:
+                sale_ids = executor.submit(
+                    get_sale_ids, database_name).result()
+            chunks = _get_chunks(sale_ids, chunk_size)
+            results = executor.map(
+                _update_sales, [database_name] * len(chunks), chunks)
+            results = [r for chunk in results for r in chunk]
+    else:
+        initializer(database_name)
+        if sale_ids is None:
+            sale_ids = get_sale_ids(database_name)
+        results = _update_sales(database_name, sale_ids)
+
+    stats = {
+        'sales': len(sale_ids),
+        'updated': 0,
+        'retries': 0,
+        'failed': [],
+        }
+    for sale_id, retries, success in results:
+        stats['retries'] += retries
+        if success:
+            stats['updated'] += 1
+        else:
+            stats['failed'].append(sale_id)
+    stats['time'] = time.monotonic() - started
+    stats['rate'] = (stats['updated'] / stats['time']
+        if stats['time'] else 0)
+    logger.info(
+        "%s: %i/%i sales updated in %.2fs (%.1f sales/s), "
+        "%i retries, %i failed", database_name, stats['updated'],
+        stats['sales'], stats['time'], stats['rate'], stats['retries'],
+        len(stats['failed']))
+    return stats
@@ -1,19 +1,204 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from decimal import Decimal
+import inspect
+from collections import defaultdict
+from contextlib import contextmanager
+from weakref import WeakKeyDictionary
+from decimal import Decimal, InvalidOperation
 
-from trytond.model import ModelView
+from sql import Cast, Literal, Null, NullsFirst, Window
+from sql.aggregate import Count, Max, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import Floor, Round
+
+from trytond import backend
+from trytond.cache import LRUDict
+from trytond.config import config
+from trytond.model import Index, ModelView, fields
+from trytond.exceptions import UserError
+from trytond.model.exceptions import AccessError
 from trytond.pool import Pool, PoolMeta
-from trytond.pyson import Eval
+from trytond.pyson import Eval, If
+from trytond.rpc import RPC
 from trytond.i18n import gettext
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction, TransactionError
+from trytond.modules.currency.fields import Monetary
+from .instrument import instrument
 
-__all__ = ['Sale', 'SaleLine']
+__all__ = ['ChaptersCache', 'LineSnapshot', 'Sale', 'SaleLine',
+    'gapped_sequences']
 
 _ZERO = Decimal(0)
+SEQUENCE_STEP = 10
+SUBTOTALS_CHUNK_SIZE = 100
+CHAPTERS_CACHE_SIZE = config.getint(
+    'sale_subchapters', 'chapters_cache', default=SUBTOTALS_CHUNK_SIZE)
+# Number of lines of a sale processed by each queued task
+SUBTOTALS_QUEUE_LINES = 1000
+IMPORT_BATCH_SIZE = 500
+_CHAPTER_TYPES = {'title', 'subtitle', 'subsubtotal', 'subtotal'}
+# Changes on these sale.line fields may move the chapter boundaries or amounts
+_CHAPTER_FIELDS = {'sale', 'type', 'chapter_level', 'sequence', 'quantity',
+    'unit_price'}
+# Type of the subtotal line that closes each type of heading
+_CLOSING_TYPES = {'title': 'subtotal', 'subtitle': 'subsubtotal'}
+# Changes on these fields of headings may require to maintain the subtotals
+_HEADING_FIELDS = {'sale', 'type', 'chapter_level', 'sequence', 'description'}
+# Sale ids whose subtotals must be maintained at the end of the deferral
+_deferred_subtotals = WeakKeyDictionary()
+
+
+def gapped_sequences(sequences, step=SEQUENCE_STEP):
+    '''Return the sequences to use for an ordered list of lines
+
+    sequences contains the current sequence of each line or None for the
+    lines that must be placed. Current values are kept whenever they leave
+    room for the lines to place before them. When a gap runs out, the
+    following lines are renumbered up to the first one that leaves room,
+    or spaced by step when none does. So dense sequences, like 1 to n, are
+    renumbered once from the first insertion to the end and later
+    insertions only place the new lines.
+    '''
+    result = list(sequences)
+    last = 0
+    i, n = 0, len(sequences)
+    while i < n:
+        j = i
+        while j < n:
+            sequence = sequences[j]
+            if sequence is not None and sequence - last > j - i:
+                break
+            j += 1
+        if j < n:
+            gap = (sequences[j] - last) // (j - i + 1)
+        else:
+            gap = step
+        for k in range(i, j):
+            last += gap
+            result[k] = last
+        if j < n:
+            last = result[j] = sequences[j]
+        i = j + 1
+    return result
+
+
+def _get_level(line):
+    "Return the nesting level of the title or subtitle line"
+    if line.type == 'title':
+        return 1
+    return getattr(line, 'chapter_level', None) or 2
+
+
+def _iter_closings(lines):
+    '''Yield the ordered lines of a sale with the heading each one closes
+
+    A title or subtitle closes the open headings of its level or deeper, a
+    subsubtotal the innermost open subtitle and a subtotal all the open
+    headings. The headings closed without a subtotal line are yielded
+    with None as line, at the place their subtotal must be generated. It
+    is a single pass over the lines keeping the stack of open headings.
+    '''
+    stack = []
+
+    def close(level):
+        while stack and stack[-1][1] >= level:
+            heading, _ = stack.pop()
+            yield None, heading
+
+    for line in lines:
+        closed = None
+        if line.type in _CLOSING_TYPES:
+            level = _get_level(line)
+            yield from close(level)
+            stack.append((line, level))
+        elif line.type == 'subsubtotal':
+            if stack and stack[-1][1] > 1:
+                closed, _ = stack.pop()
+        elif line.type == 'subtotal':
+            yield from close(2)
+            if stack:
+                closed, _ = stack.pop()
+        yield line, closed
+    yield from close(1)
+
+
+class LineSnapshot(object):
+    "Column values of a sale line used by the chapter computations"
+    __slots__ = ('id', 'sale', 'type', 'chapter_level', 'sequence',
+        'amount', 'description', 'chapter', 'chapter_amount')
+
+    def __init__(self, id, sale, type, chapter_level, sequence, amount,
+            description, chapter, chapter_amount):
+        self.id = id
+        self.sale = sale
+        self.type = type
+        self.chapter_level = chapter_level
+        self.sequence = sequence
+        self.amount = amount
+        self.description = description
+        self.chapter = chapter
+        self.chapter_amount = chapter_amount
+
+
+class ChaptersCache(object):
+    """Chapter structure of the sales cached for the current transaction
+
+    The entry of a sale is removed every time its lines are created, written
+    or deleted, so a stale entry is never returned. Only the structures of the
+    last CHAPTERS_CACHE_SIZE sales used are kept.
+    """
+    __slots__ = ('values',)
+    _transactions = WeakKeyDictionary()
+
+    def __init__(self, size_limit=None):
+        if size_limit is None:
+            size_limit = CHAPTERS_CACHE_SIZE
+        self.values = LRUDict(size_limit)
+
+    @classmethod
+    def get_cache(cls):
+        "Return the cache of the current transaction"
+        transaction = Transaction()
+        cache = cls._transactions.get(transaction)
+        if cache is None:
+            cache = cls._transactions[transaction] = cls()
+        return cache
+
+    def get(self, sale_id):
+        value = self.values.get(sale_id)
+        if value is not None:
+            self.values.move_to_end(sale_id)
+        return value
+
+    def set(self, sale_id, value):
+        self.values[sale_id] = value
+        self.values.move_to_end(sale_id)
+
+    def invalidate(self, sale_ids):
+        for sale_id in sale_ids:
+            self.values.pop(sale_id, None)
 
 
 class Sale(metaclass=PoolMeta):
     __name__ = 'sale.sale'
+    subtotals_queued = fields.Boolean("Subtotals Update Queued",
+        readonly=True,
+        help="The subtotals are being updated in the background.\n"
+        "The lines can not be modified until it finishes.")
+    subtotals_processed = fields.Integer("Subtotals Processed Lines",
+        readonly=True,
+        states={
+            'invisible': ~Eval('subtotals_queued', False),
+            },
+        help="The number of lines already processed by the background "
+        "update of the subtotals.")
+    subtotals_lines = fields.Integer("Subtotals Lines", readonly=True,
+        states={
+            'invisible': ~Eval('subtotals_queued', False),
+            },
+        help="The number of lines to process by the background update of "
+        "the subtotals.")
 
     @classmethod
     def __setup__(cls):
@@ -21,57 +206,701 @@ class Sale(metaclass=PoolMeta):
         cls._buttons.update({
                 'update_subtotals': {
                     'invisible': Eval('state') != 'draft',
-                    'readonly': ~Eval('lines', []),
+                    'readonly': (~Eval('lines', [])
+                        | Eval('subtotals_queued', False)),
                     'icon': 'tryton-refresh',
+                    'depends': ['subtotals_queued'],
                     },
                 })
+        cls.__rpc__.update({
+                'get_chapter_summary': RPC(readonly=True, instantiate=0),
+                })
+
+    @staticmethod
+    def default_subtotals_queued():
+        return False
+
+    @classmethod
+    def copy(cls, sales, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        default.setdefault('subtotals_queued', False)
+        default.setdefault('subtotals_processed', None)
+        default.setdefault('subtotals_lines', None)
+        return super(Sale, cls).copy(sales, default=default)
+
+    @classmethod
+    def create(cls, vlist):
+        with cls.defer_subtotals():
+            return super(Sale, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        sale_ids = []
+        for sales, values in zip(actions, actions):
+            if 'currency' in values:
+                sale_ids.extend(s.id for s in sales)
+        with cls.defer_subtotals():
+            super(Sale, cls).write(*args)
+            ChaptersCache.get_cache().invalidate(sale_ids)
+
+    @classmethod
+    def delete(cls, sales):
+        sale_ids = [s.id for s in sales]
+        with cls.defer_subtotals():
+            super(Sale, cls).delete(sales)
+            ChaptersCache.get_cache().invalidate(sale_ids)
+
+    @classmethod
+    @contextmanager
+    def defer_subtotals(cls):
+        '''Maintain the subtotals of the sales modified inside the block once
+
+        The sales whose titles or subtitles are created, written or deleted
+        inside the block are restructured when the outermost block exits
+        instead of after each modification.
+        Sale.create, write and delete use a block per call, so the changes
+        are coalesced only within a call: separate calls in the same
+        transaction each restructure their sales, unless the caller wraps
+        them in a single block.
+        '''
+        transaction = Transaction()
+        if transaction in _deferred_subtotals:
+            yield
+            return
+        sale_ids = _deferred_subtotals[transaction] = set()
+        try:
+            yield
+        finally:
+            del _deferred_subtotals[transaction]
+        if sale_ids:
+            # The sales may have been deleted inside the block
+            cls._maintain_subtotals(cls.search([
+                        ('id', 'in', list(sale_ids)),
+                        ], order=[('id', 'ASC')]))
+
+    @classmethod
+    def _subtotals_outdated(cls, sale_ids):
+        "Maintain the subtotals of the sales now or when the deferral ends"
+        if (not sale_ids
+                or not Transaction().context.get(
+                    '_sale_subtotals_maintain', True)):
+            return
+        deferred = _deferred_subtotals.get(Transaction())
+        if deferred is not None:
+            deferred.update(sale_ids)
+        else:
+            cls._maintain_subtotals(cls.browse(sale_ids))
+
+    def _auto_subtotals(self):
+        "Return whether the subtotals of the sale are maintained"
+        return bool(self.state == 'draft'
+            and not self.subtotals_queued
+            and self.company.sale_subtotals_auto)
+
+    @classmethod
+    def _maintain_subtotals(cls, sales):
+        '''Generate the missing subtotals of the sales in automatic mode and
+        rename the generated ones to follow their heading
+
+        The layout is computed over the whole sale, as a heading may close
+        any chapter after it, but from the snapshots read once for all the
+        edits of the deferral. Only the new subtotals and the lines left
+        without room before them are written.
+        '''
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        sales = [s for s in sales if s._auto_subtotals()]
+        if sales:
+            cls._update_subtotals(sales)
+            SaleLine._update_subtotal_descriptions(sales)
+
+    @fields.depends(methods=['_set_chapter_amounts'])
+    def on_change_lines(self):
+        super(Sale, self).on_change_lines()
+        self._set_chapter_amounts()
+
+    @fields.depends('lines')
+    def _set_chapter_amounts(self):
+        '''Update the amount of the subsubtotal and subtotal lines
+
+        The client does not tell which line was edited so the lines are
+        swept once, like SaleLine._get_chapters does, but only the
+        subtotals of the chapters whose total changed are set and sent
+        back.
+        '''
+        subsubtotal = subtotal = _ZERO
+        # Level and total of the open headings
+        stack = []
+
+        def close(level):
+            while stack and stack[-1][0] >= level:
+                _, total = stack.pop()
+                if stack:
+                    stack[-1][1] += total
+
+        for line in self.lines or []:
+            type_ = getattr(line, 'type', None)
+            if type_ == 'line':
+                amount = getattr(line, 'amount', None) or _ZERO
+                subsubtotal += amount
+                subtotal += amount
+                if stack:
+                    stack[-1][1] += amount
+            elif type_ in _CLOSING_TYPES:
+                level = _get_level(line)
+                close(level)
+                stack.append([level, _ZERO])
+                subsubtotal = _ZERO
+            elif type_ == 'subsubtotal':
+                amount = subsubtotal
+                if stack and stack[-1][0] > 1:
+                    amount = stack[-1][1]
+                    close(stack[-1][0])
+                if getattr(line, 'amount', None) != amount:
+                    line.amount = amount
+                subsubtotal = _ZERO
+            elif type_ == 'subtotal':
+                if getattr(line, 'amount', None) != subtotal:
+                    line.amount = subtotal
+                close(1)
+                subsubtotal = subtotal = _ZERO
 
     @classmethod
     @ModelView.button
     def update_subtotals(cls, sales):
+        transaction = Transaction()
+        context = transaction.context
+        # The queued sales are already being updated
+        sales = [s for s in sales if not s.subtotals_queued]
+        counts = cls._count_lines(sales)
+        to_queue, to_update = [], []
+        for sale in sales:
+            threshold = sale.company.sale_subtotals_queue_threshold
+            if threshold and counts.get(sale.id, 0) >= threshold:
+                to_queue.append(sale)
+            else:
+                to_update.append(sale)
+        if to_queue:
+            to_write = []
+            for sale in to_queue:
+                to_write.extend(([sale], {
+                            'subtotals_queued': True,
+                            'subtotals_processed': 0,
+                            'subtotals_lines': counts[sale.id],
+                            }))
+            cls.write(*to_write)
+            with transaction.set_context(
+                    queue_batch=context.get('queue_batch', True)):
+                cls.__queue__.process_subtotals(to_queue)
+        cls._update_subtotals(to_update)
+
+    @classmethod
+    def process_subtotals(cls, sales):
+        '''Update the subtotals of the sales queued by update_subtotals
+
+        Each call processes about SUBTOTALS_QUEUE_LINES lines of each sale
+        and queues itself again for the sales not finished, so the progress
+        is stored by each task. The sales are released if it fails.
+        '''
+        transaction = Transaction()
+        cls.lock(sales)
+        sales = [s for s in sales if s.subtotals_queued]
+        if not sales:
+            return
+        try:
+            cls._process_subtotals(sales)
+        except (TransactionError, backend.DatabaseOperationalError):
+            # The task is retried
+            raise
+        except Exception:
+            transaction.rollback()
+            with transaction.new_transaction():
+                cls.write(cls.browse([s.id for s in sales]), {
+                        'subtotals_queued': False,
+                        'subtotals_processed': None,
+                        'subtotals_lines': None,
+                        })
+            raise
+
+    @classmethod
+    def _process_subtotals(cls, sales, size=SUBTOTALS_QUEUE_LINES):
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+
+        to_write, pending = [], []
+        # The lines of the queued sales are modified only here
+        with instrument('process_subtotals') as stats, \
+                Transaction().set_context(
+                    _sale_subtotals_maintain=False,
+                    _sale_subtotals_process=True):
+            structures = SaleLine._get_sales_chapters([s.id for s in sales])
+            for sale in sales:
+                lines, _ = structures[sale.id]
+                layout = cls._get_subtotals_layout(lines)
+                start = sale.subtotals_processed or 0
+                stop = cls._get_subtotals_layout_stop(layout, start + size)
+                written, created = cls._apply_subtotals_layout(
+                    layout[start:stop])
+                stats.lines += stop - start
+                stats.written += written
+                stats.created += created
+                values = {
+                    'subtotals_processed': stop,
+                    'subtotals_lines': len(layout),
+                    }
+                if stop >= len(layout):
+                    values['subtotals_queued'] = False
+                else:
+                    pending.append(sale)
+                to_write.extend(([sale], values))
+        cls.write(*to_write)
+        if pending:
+            cls.__queue__.process_subtotals(pending)
+
+    @staticmethod
+    def _get_subtotals_layout_stop(layout, stop):
+        '''Return the end of the first part of the layout with at least stop
+        items that can be applied alone
+
+        The part must end with an existing line that keeps its sequence, so
+        the lines after it, not renumbered yet, stay in order.
+        '''
+        for i in range(stop - 1, len(layout)):
+            line, new, sequence = layout[i]
+            if not new and line.sequence == sequence:
+                return i + 1
+        return len(layout)
+
+    @classmethod
+    def _count_lines(cls, sales):
+        "Return the number of lines of each sale"
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        line = SaleLine.__table__()
+        cursor = Transaction().connection.cursor()
+        counts = {}
+        for sub_ids in grouped_slice([s.id for s in sales]):
+            cursor.execute(*line.select(line.sale, Count(Literal('*')),
+                    where=reduce_ids(line.sale, sub_ids),
+                    group_by=[line.sale]))
+            counts.update(cursor)
+        return counts
+
+    @classmethod
+    def _update_subtotals(cls, sales, chunk_size=SUBTOTALS_CHUNK_SIZE):
+        """Generate the missing subtotal lines of the sales
+
+        The sales are processed by chunks of chunk_size: the sales of a
+        chunk are locked, their lines are read with a single search and the
+        changes are flushed before the next chunk is read.
+        """
         pool = Pool()
         SaleLine = pool.get('sale.line')
 
+        # The headings moved here must not trigger the automatic mode
+        with instrument('update_subtotals') as stats, \
+                Transaction().set_context(_sale_subtotals_maintain=False):
+            for sub_sales in grouped_slice(sales, chunk_size):
+                sub_sales = list(sub_sales)
+                cls.lock(sub_sales)
+                # The queue takes care of the queued sales
+                sub_sales = [s for s in sub_sales if not s.subtotals_queued]
+                structures = SaleLine._get_sales_chapters(
+                    [s.id for s in sub_sales])
+                layouts = []
+                for lines, _ in structures.values():
+                    layouts.extend(cls._get_subtotals_layout(lines))
+                    stats.lines += len(lines)
+                written, created = cls._apply_subtotals_layout(layouts)
+                stats.written += written
+                stats.created += created
+
+    @classmethod
+    def _apply_subtotals_layout(cls, layouts):
+        '''Create the missing subtotals and renumber the lines of the layouts
+
+        Return the number of lines written and created.
+        '''
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        headings = SaleLine.browse([l.id for l, new, _ in layouts if new])
+        headings = {h.id: h for h in headings}
+
         to_create = []
-        for sale in sales:
-            title = subtitle = None
-            sequence = 1
-            for line in sale.lines:
-                if line.type == 'subsubtotal':
-                    subtitle = None
-                elif line.type in ('subtotal', 'subtitle', 'title'):
-                    if subtitle:
-                        to_create.append(
-                            subtitle.get_subtotal(sequence)._save_values())
-                        sequence += 1
-                    if line.type == 'subtotal':
-                        title = subtitle = None
-                    elif line.type == 'subtitle':
-                        subtitle = line
-                    elif line.type == 'title':
-                        if title:
-                            to_create.append(
-                                title.get_subtotal(sequence)._save_values())
-                            sequence += 1
-                        title = line
-                        subtitle = None
-                if line.sequence != sequence:
-                    line.sequence = sequence
-                    line.save()
-                sequence += 1
-            if subtitle:
-                to_create.append(
-                    subtitle.get_subtotal(sequence)._save_values())
-                sequence += 1
-            if title:
-                to_create.append(
-                    title.get_subtotal(sequence)._save_values())
+        to_write = []
+        for line, new, sequence in layouts:
+            if new:
+                to_create.append(headings[line.id].get_subtotal(
+                        sequence)._save_values())
+            elif line.sequence != sequence:
+                to_write.append((line, {'sequence': sequence}))
+        if to_write:
+            SaleLine.write(*SaleLine._get_snapshot_actions(to_write))
         if to_create:
             SaleLine.create(to_create)
+        return len(to_write), len(to_create)
+
+    @staticmethod
+    def _get_subtotals_layout(lines):
+        """Return the final layout of the lines of a sale
+
+        The result is the ordered list of the existing lines and of the
+        headings whose missing subtotal must be generated, as tuples of the
+        line snapshot, whether a subtotal must be created and its sequence.
+        """
+        items = [(heading, True) if line is None else (line, False)
+            for line, heading in _iter_closings(lines)]
+        sequences = gapped_sequences(
+            [None if new else line.sequence for line, new in items])
+        return [(line, new, sequence)
+            for (line, new), sequence in zip(items, sequences)]
+
+    @classmethod
+    def get_chapter_summary(cls, sales):
+        '''Return the chapter tree of the sales
+
+        The result is a list with a dictionary per sale with its id and its
+        chapters. Each chapter is a dictionary with the id, type and
+        description of its title or subtitle line, the number of lines and
+        the total it contains and its children chapters. It does not
+        depend on the subtotal lines being generated.
+        '''
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        structures = SaleLine._get_sales_chapters([s.id for s in sales])
+        return [{
+                'id': sale.id,
+                'chapters': SaleLine._get_chapter_tree(
+                    *structures[sale.id]),
+                } for sale in sales]
+
+    def create_invoice(self):
+        invoice = super(Sale, self).create_invoice()
+        if invoice:
+            self._set_invoice_chapters(invoice)
+        return invoice
+
+    def _set_invoice_chapters(self, invoice):
+        '''Insert the chapter lines of the sale into the new invoice lines
+
+        The titles, subtitles and their subtotals are recreated in the sale
+        order for the chapters with at least one line invoiced in this run.
+        When the invoice groups several sales, the lines of the sale are
+        placed after the lines already on it.
+        '''
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+
+        existing, by_origin, others = [], defaultdict(list), []
+        for line in invoice.lines:
+            origin = getattr(line, 'origin', None)
+            if line.id is not None and line.id >= 0:
+                existing.append(line)
+            elif (isinstance(origin, SaleLine) and origin.sale
+                    and origin.sale.id == self.id):
+                by_origin[origin.id].append(line)
+            else:
+                others.append(line)
+        if not by_origin:
+            return
+
+        (lines, chapters), = SaleLine._get_sales_chapters([self.id]).values()
+        used = set()
+        for line in lines:
+            if line.type == 'line' and line.id in by_origin:
+                chapter, _ = chapters[line.id]
+                while chapter and chapter not in used:
+                    used.add(chapter)
+                    chapter, _ = chapters[chapter]
+
+        def in_used_chapter(line):
+            if line.type in {'title', 'subtitle'}:
+                return line.id in used
+            return chapters[line.id][0] in used
+        chapter_lines = SaleLine.browse([l.id for l in lines
+                if l.type in _CHAPTER_TYPES and in_used_chapter(l)])
+        chapter_lines = {l.id: l for l in chapter_lines}
+
+        offset = max((l.sequence for l in existing + others
+                if getattr(l, 'sequence', None) is not None), default=0)
+        invoice_lines = []
+        for line in lines:
+            if line.id in chapter_lines:
+                new_lines = [chapter_lines[line.id].get_chapter_invoice_line()]
+            else:
+                new_lines = by_origin.get(line.id, [])
+            for invoice_line in new_lines:
+                invoice_line.sequence = offset + (line.sequence or 0)
+            invoice_lines.extend(new_lines)
+        invoice.lines = existing + invoice_lines + others
+
+    @classmethod
+    def update_draft_subtotals(cls, domain=None):
+        "Update the subtotals of the draft sales matching the domain"
+        sales = cls.search([
+                ('state', '=', 'draft'),
+                ('subtotals_queued', '=', False),
+                domain or [],
+                ], order=[('id', 'ASC')])
+        cls._update_subtotals(sales)
+
+    def import_lines(self, rows, batch_size=IMPORT_BATCH_SIZE):
+        '''Append the rows as lines of the sale in a single pass
+
+        rows is an iterable of dictionaries with the type, level,
+        description, product code, quantity and unit price of each line.
+        The level of the subtitles sets their nesting.
+        The subtotals are generated as the chapters are closed and the
+        lines are created by batches of batch_size, so the rows are never
+        all loaded in memory. Return the number of lines created.
+        '''
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        table = SaleLine.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*table.select(Max(table.sequence),
+                where=table.sale == self.id))
+        last_sequence = cursor.fetchone()[0] or 0
+        products = {}
+        batch = []
+        count = 0
+
+        def flush():
+            nonlocal count
+            SaleLine.save(batch)
+            count += len(batch)
+            del batch[:]
+
+        def append(line):
+            nonlocal last_sequence
+            last_sequence += SEQUENCE_STEP
+            line.sequence = last_sequence
+            batch.append(line)
+            if len(batch) >= batch_size:
+                flush()
+
+        lines = (self._get_import_line(
+                self._get_import_type(row, number), row, number, products)
+            for number, row in enumerate(rows, 1))
+        # The chapters are computed once at the end
+        with Transaction().set_context(
+                _sale_subtotals_maintain=False, _sale_chapters_update=False):
+            for line in self._close_chapters(lines):
+                append(line)
+            if batch:
+                flush()
+        ChaptersCache.get_cache().invalidate([self.id])
+        SaleLine._update_chapters([self])
+        return count
+
+    def insert_chapter_template(self, template, after=None):
+        '''Insert the lines of the chapter template after the sale line
+
+        The lines are added at the end of the sale when after is None. The
+        subtotals of the template chapters are generated with them and all
+        the new lines are created at once. When inserted inside a chapter,
+        the template headings are nested under it so only the chapters of
+        the template are closed. The existing lines keep their sequence
+        unless there is no room left before the next one. Return the new
+        lines.
+        '''
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+
+        template_lines = [l.get_sale_line(self) for l in template.lines]
+        if not template_lines:
+            return []
+        self.lock()
+        (lines, _), = SaleLine._get_sales_chapters([self.id]).values()
+        position = len(lines)
+        if after:
+            position = next((i + 1 for i, l in enumerate(lines)
+                    if l.id == after.id), position)
+        self._nest_template_lines(
+            template_lines, self._get_insertion_level(lines, position))
+        new_lines = list(self._close_chapters(template_lines))
+        sequences = gapped_sequences(
+            [l.sequence for l in lines[:position]]
+            + [None] * len(new_lines)
+            + [l.sequence for l in lines[position:]])
+        end = position + len(new_lines)
+        for line, sequence in zip(new_lines, sequences[position:end]):
+            line.sequence = sequence
+
+        to_write = []
+        existing = zip(lines, sequences[:position] + sequences[end:])
+        for line, sequence in existing:
+            if line.sequence != sequence:
+                to_write.append((line, {'sequence': sequence}))
+        # The chapters are computed once at the end
+        with Transaction().set_context(
+                _sale_subtotals_maintain=False, _sale_chapters_update=False):
+            if to_write:
+                SaleLine.write(*SaleLine._get_snapshot_actions(to_write))
+            SaleLine.save(new_lines)
+        ChaptersCache.get_cache().invalidate([self.id])
+        SaleLine._update_chapters([self])
+        return new_lines
+
+    @staticmethod
+    def _get_insertion_level(lines, position):
+        '''Return the level of the innermost chapter that continues after
+        the position or 0
+
+        lines are the snapshots of the lines of the sale in order.
+        '''
+        open_levels, stack = [], []
+        for line, heading in _iter_closings(lines[:position]):
+            if line is None or heading:
+                stack.pop()
+            elif line.type in _CLOSING_TYPES:
+                stack.append(_get_level(line))
+            # The closings after the last line are ignored
+            if line is not None:
+                open_levels = list(stack)
+        if position < len(lines):
+            following = lines[position]
+            if following.type in _CLOSING_TYPES:
+                level = _get_level(following)
+                open_levels = [l for l in open_levels if l < level]
+        return open_levels[-1] if open_levels else 0
+
+    @staticmethod
+    def _nest_template_lines(lines, level):
+        "Turn the headings of the template lines into subtitles below level"
+        levels = [_get_level(l) for l in lines if l.type in _CLOSING_TYPES]
+        if not level or not levels or min(levels) > level:
+            return
+        offset = level + 1 - min(levels)
+        for line in lines:
+            if line.type in _CLOSING_TYPES:
+                line.chapter_level = _get_level(line) + offset
+                line.type = 'subtitle'
+
+    @staticmethod
+    def _close_chapters(lines):
+        '''Yield the new lines with the subtotals of their chapters
+
+        The subsubtotal and subtotal lines are generated with get_subtotal
+        as soon as the chapter they close ends. The given subsubtotal and
+        subtotal lines only end the chapters. It consumes the lines one by
+        one and only keeps the open headings.
+        '''
+        for line, heading in _iter_closings(lines):
+            if line is None or line.type in {'subsubtotal', 'subtotal'}:
+                if heading:
+                    yield heading.get_subtotal(None)
+            else:
+                yield line
+
+    @staticmethod
+    def _get_import_type(row, number):
+        '''Return the line type of the imported row
+
+        Without type, rows are titles with level 1 and subtitles with a
+        greater level. Rows with neither level, product, quantity nor unit
+        price are titles.
+        '''
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        type_ = (row.get('type') or '').strip().lower()
+        level = str(row.get('level') or '').strip()
+        if not type_ and level:
+            try:
+                type_ = 'title' if int(level) <= 1 else 'subtitle'
+            except ValueError:
+                raise UserError(gettext(
+                        'sale_subchapters.msg_import_invalid_value',
+                        row=number, field='level', value=level))
+        elif not type_:
+            if any(row.get(f) not in {None, ''}
+                    for f in ['product', 'quantity', 'unit_price']):
+                type_ = 'line'
+            else:
+                type_ = 'title'
+        if type_ not in dict(SaleLine.type.selection):
+            raise UserError(gettext(
+                    'sale_subchapters.msg_import_invalid_type',
+                    row=number, type=type_))
+        return type_
+
+    def _get_import_line(self, type_, row, number, products):
+        "Return the sale line of the imported row"
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        Product = pool.get('product.product')
+
+        def value(field, convert):
+            value = row.get(field)
+            if value in {None, ''}:
+                return None
+            try:
+                return convert(str(value).strip())
+            except (ValueError, InvalidOperation):
+                raise UserError(gettext(
+                        'sale_subchapters.msg_import_invalid_value',
+                        row=number, field=field, value=value))
+
+        line = SaleLine(sale=self, type=type_)
+        if type_ == 'subtitle':
+            line.chapter_level = value('level', int)
+        elif type_ == 'line':
+            line.quantity = value('quantity', float)
+            code = value('product', str)
+            if code:
+                if code not in products:
+                    found = Product.search([('code', '=', code)], limit=1)
+                    if not found:
+                        raise UserError(gettext('sale_subchapters'
+                                '.msg_import_product_not_found',
+                                row=number, product=code))
+                    products[code], = found
+                line.product = products[code]
+                line.on_change_product()
+            unit_price = value('unit_price', Decimal)
+            if unit_price is not None:
+                line.unit_price = unit_price
+        description = value('description', str)
+        if description is not None:
+            line.description = description
+        return line
 
 
 class SaleLine(metaclass=PoolMeta):
     __name__ = 'sale.line'
+    chapter = fields.Many2One('sale.line', "Chapter", readonly=True,
+        ondelete='SET NULL',
+        domain=[
+            ('sale', '=', Eval('sale', -1)),
+            ('type', 'in', ['title', 'subtitle']),
+            ],
+        help="The title or subtitle the line belongs to.")
+    chapter_lines = fields.One2Many('sale.line', 'chapter', "Chapter Lines",
+        readonly=True)
+    chapter_amount = Monetary("Chapter Amount", digits='currency',
+        currency='currency', readonly=True,
+        help="The total of the chapter for titles and subtitles and the "
+        "amount of subsubtotals.")
+    chapter_level = fields.Integer("Level",
+        domain=[
+            If(Eval('type') == 'subtitle',
+                ['OR',
+                    ('chapter_level', '=', None),
+                    ('chapter_level', '>=', 2),
+                    ],
+                []),
+            ],
+        states={
+            'invisible': Eval('type') != 'subtitle',
+            },
+        help="The nesting level of the subtitle, 2 being directly under "
+        "the title.\n"
+        "Leave empty for 2.")
 
     @classmethod
     def __setup__(cls):
@@ -80,24 +909,538 @@ class SaleLine(metaclass=PoolMeta):
             if item not in cls.type.selection:
                 cls.type.selection.append(item)
         cls.amount.states['invisible'] &= (Eval('type') != 'subsubtotal')
+        cls.amount.searcher = 'search_amount'
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.sale, Index.Range()),
+                where=t.type.in_(['title', 'subtitle'])))
+
+    @classmethod
+    def __register__(cls, module_name):
+        table_h = cls.__table_handler__(module_name)
+        backfill = not table_h.column_exist('chapter_amount')
+
+        super(SaleLine, cls).__register__(module_name)
+
+        # Migration from 7.6: store the chapters of the existing lines
+        if backfill:
+            cls._backfill_chapters()
+
+    @classmethod
+    def _backfill_chapters(cls):
+        '''Store the chapter and chapter amount of the lines of all the sales
+        with chapter lines
+
+        The columns are updated by SQL, without the checks and the
+        maintenance done by write, with one query per distinct value.
+        '''
+        line = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*line.select(line.sale,
+                where=line.type.in_(['title', 'subtitle', 'subsubtotal'])
+                & (line.sale != Null),
+                group_by=[line.sale]))
+        sale_ids = [s for s, in cursor]
+        for sub_ids in grouped_slice(sale_ids, SUBTOTALS_CHUNK_SIZE):
+            values = defaultdict(list)
+            for lines in cls._get_snapshots(list(sub_ids)).values():
+                chapters = cls._get_chapters(lines)
+                for snapshot in lines:
+                    chapter, amount = chapters[snapshot.id]
+                    if (snapshot.chapter != chapter
+                            or snapshot.chapter_amount != amount):
+                        values[chapter, amount].append(snapshot.id)
+            for (chapter, amount), line_ids in values.items():
+                for sub_line_ids in grouped_slice(line_ids):
+                    cursor.execute(*line.update(
+                            [line.chapter, line.chapter_amount],
+                            [chapter, amount],
+                            where=reduce_ids(line.id, sub_line_ids)))
+
+    @classmethod
+    def get_amount(cls, lines, name):
+        amounts = {}
+        subsubtotals = [l for l in lines if l.type == 'subsubtotal']
+        # The amount of subtotals is computed by the database instead of
+        # reading all the lines of the sale for each of them
+        subtotals = [l for l in lines if l.type == 'subtotal']
+        others = [l for l in lines
+            if l.type not in {'subsubtotal', 'subtotal'}]
+        if others:
+            getter = super(SaleLine, cls).get_amount
+            if inspect.ismethod(getter):
+                amounts.update(getter(others, name))
+            else:
+                for line in others:
+                    amounts[line.id] = getter(line, name)
+        if subsubtotals:
+            with instrument('get_amount') as stats:
+                amounts.update(cls._get_subsubtotal_amounts(subsubtotals))
+                stats.lines += len(subsubtotals)
+        if subtotals:
+            with instrument('get_amount') as stats:
+                amounts.update(cls._get_sql_amounts(subtotals))
+                for line in subtotals:
+                    amounts.setdefault(line.id, _ZERO)
+                stats.lines += len(subtotals)
+        return amounts
+
+    @classmethod
+    def _get_subsubtotal_amounts(cls, subsubtotals):
+        amounts = {}
+        missing = []
+        for line in subsubtotals:
+            if line.chapter_amount is not None:
+                amounts[line.id] = line.chapter_amount
+            else:
+                missing.append(line)
+        cache = ChaptersCache.get_cache()
+        uncached = []
+        for line in missing:
+            structure = cache.get(line.sale.id)
+            # Lines created after the structure was cached are not in it
+            if structure is not None and line.id in structure[1]:
+                _, chapters = structure
+                amounts[line.id] = chapters[line.id][1]
+            else:
+                uncached.append(line)
+        if uncached:
+            amounts.update(cls._get_sql_amounts(uncached))
+        for line in subsubtotals:
+            amounts.setdefault(line.id, _ZERO)
+        return amounts
+
+    @classmethod
+    def _get_sql_amounts(cls, lines):
+        "Return the amount of the lines computed by the database"
+        cursor = Transaction().connection.cursor()
+        amounts = {}
+        sale_ids = {l.sale.id for l in lines}
+        line_ids = {l.id for l in lines}
+        for sub_sale_ids in grouped_slice(sale_ids):
+            query = cls._amount_query(list(sub_sale_ids))
+            cursor.execute(*query.select(query.id, query.amount))
+            for line_id, amount in cursor:
+                if line_id in line_ids:
+                    # SQLite may return float or text
+                    amounts[line_id] = Decimal(str(amount or 0))
+        return amounts
+
+    @classmethod
+    def _amount_query(cls, sale_ids=None):
+        """Return a query with the id and the amount of the sale lines
+
+        The amount of subsubtotal and subtotal lines is computed with window
+        functions over the lines of each sale ordered by sequence: a
+        subsubtotal adds up the lines since the last title, subtitle,
+        subtotal or subsubtotal and a subtotal the lines since the last
+        subtotal. The stored chapter amount of subsubtotals is preferred
+        when it exists, as only it accounts for the subsubtotals closing a
+        subtitle with nested subtitles. Line amounts are rounded half even like
+        currency.round.
+        """
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Currency = pool.get('currency.currency')
+        line = cls.__table__()
+        sale = Sale.__table__()
+        currency = Currency.__table__()
+
+        where = Literal(True)
+        if sale_ids is not None:
+            where &= reduce_ids(line.sale, sale_ids)
+
+        unrounded = (Coalesce(Cast(line.quantity, 'NUMERIC'), 0)
+            * Coalesce(line.unit_price, 0) / currency.rounding)
+        rounded = Case(
+            ((unrounded - Floor(unrounded)) == 0.5,
+                Round(unrounded / 2) * 2),
+            else_=Round(unrounded)) * currency.rounding
+        boundary = Case(
+            (line.type.in_(['title', 'subtitle', 'subtotal', 'subsubtotal']),
+                1),
+            else_=0)
+        closing = Case((line.type == 'subtotal', 1), else_=0)
+        lines = line.join(sale, condition=line.sale == sale.id
+            ).join(currency, condition=sale.currency == currency.id
+            ).select(
+                line.id, line.sale, line.type, line.sequence,
+                line.chapter_amount,
+                Case((line.type == 'line', rounded),
+                    else_=0).as_('line_amount'),
+                boundary.as_('boundary'),
+                closing.as_('closing'),
+                where=where)
+
+        window = Window([lines.sale],
+            order_by=[NullsFirst(lines.sequence), lines.id])
+        chapters = lines.select(
+            lines.id, lines.sale, lines.type, lines.chapter_amount,
+            lines.line_amount,
+            (Sum(lines.boundary, window=window) - lines.boundary
+                ).as_('chapter'),
+            (Sum(lines.closing, window=window) - lines.closing
+                ).as_('subtotal'))
 
-    def get_amount(self, name):
-        if self.type != 'subsubtotal':
-            return super(SaleLine, self).get_amount(name)
+        subsubtotal = Sum(chapters.line_amount,
+            window=Window([chapters.sale, chapters.chapter]))
+        subtotal = Sum(chapters.line_amount,
+            window=Window([chapters.sale, chapters.subtotal]))
+        return chapters.select(
+            chapters.id,
+            Case(
+                (chapters.type == 'line', chapters.line_amount),
+                (chapters.type == 'subsubtotal',
+                    Coalesce(chapters.chapter_amount, subsubtotal)),
+                (chapters.type == 'subtotal', subtotal),
+                else_=0).as_('amount'))
+
+    @classmethod
+    def search_amount(cls, name, clause):
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        field = cls.amount._field
+        query = cls._amount_query()
+        return [('id', 'in', query.select(query.id,
+                    where=Operator(query.amount,
+                        field._domain_value(operator, value))))]
+
+    @classmethod
+    def _get_snapshots(cls, sale_ids):
+        """Return the snapshots of the lines of the sales in order
+
+        The lines are read with one query per chunk of sales without
+        instantiating any record, and the amount of the lines is rounded
+        with the currency of their sale, resolved once per sale.
+        """
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        line = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        sales = {s.id: s for s in Sale.browse(sale_ids)}
+        rounds = {}
+        snapshots = {i: [] for i in sale_ids}
+        for sub_ids in grouped_slice(sale_ids):
+            cursor.execute(*line.select(
+                    line.sale, line.id, line.type, line.chapter_level,
+                    line.sequence, line.quantity, line.unit_price,
+                    line.description, line.chapter, line.chapter_amount,
+                    where=reduce_ids(line.sale, sub_ids),
+                    order_by=[
+                        line.sale, NullsFirst(line.sequence), line.id]))
+            for (sale_id, line_id, type_, level, sequence, quantity,
+                    unit_price, description, chapter,
+                    chapter_amount) in cursor:
+                amount = None
+                if type_ == 'line':
+                    round_ = rounds.get(sale_id)
+                    if round_ is None:
+                        round_ = rounds[sale_id] = (
+                            sales[sale_id].currency.round)
+                    amount = round_(Decimal(str(quantity or 0))
+                        * Decimal(str(unit_price or 0)))
+                if chapter_amount is not None:
+                    chapter_amount = Decimal(str(chapter_amount))
+                snapshots[sale_id].append(LineSnapshot(
+                        line_id, sale_id, type_, level, sequence, amount,
+                        description, chapter, chapter_amount))
+        return snapshots
+
+    @staticmethod
+    def _get_chapters(lines):
+        """Return the chapter and chapter amount of the lines of a sale
+
+        lines must be the snapshots of all the lines of the sale in order.
+        The result maps each line id to its enclosing title or subtitle id
+        and its chapter amount (None for the lines that have none). It is
+        computed in a single sweep keeping the stack of the open headings:
+        the amount of a line is only added to the innermost chapter and the
+        total of a chapter to its parent when it is closed, so the cost
+        does not depend on the depth.
+
+        A subsubtotal that closes a subtitle amounts to its total, the
+        others to the lines since the previous heading or subsubtotal.
+        """
+        chapters = {}
+        totals = {}
+        stack = []
         subsubtotal = _ZERO
-        for line2 in self.sale.lines:
-            if line2.type in ['title','subtitle']:
+
+        def close(level):
+            while stack and stack[-1][1] >= level:
+                heading, _ = stack.pop()
+                if stack:
+                    totals[stack[-1][0].id] += totals[heading.id]
+
+        for line in lines:
+            chapter = stack[-1][0] if stack else None
+            amount = None
+            type_ = line.type
+            if type_ == 'line':
+                subsubtotal += line.amount
+                if chapter:
+                    totals[chapter.id] += line.amount
+            elif type_ in _CLOSING_TYPES:
+                level = _get_level(line)
+                close(level)
+                chapter = stack[-1][0] if stack else None
+                stack.append((line, level))
+                totals[line.id] = _ZERO
                 subsubtotal = _ZERO
-            if line2.type in ['comment']:
-                continue
-            if line2.type == 'line':
-                subsubtotal += line2.sale.currency.round(
-                    Decimal(str(line2.quantity)) * line2.unit_price)
-            elif line2.type in ('subtotal', 'subsubtotal'):
-                if self == line2:
-                    break
+            elif type_ == 'subsubtotal':
+                if stack and stack[-1][1] > 1:
+                    close(stack[-1][1])
+                    amount = totals[chapter.id]
+                else:
+                    amount = subsubtotal
                 subsubtotal = _ZERO
-        return subsubtotal
+            elif type_ == 'subtotal':
+                chapter = stack[0][0] if stack and stack[0][1] == 1 else None
+                close(1)
+                subsubtotal = _ZERO
+            chapters[line.id] = (chapter.id if chapter else None, amount)
+        close(1)
+        for line_id, total in totals.items():
+            chapters[line_id] = (chapters[line_id][0], total)
+        return chapters
+
+    @staticmethod
+    def _get_chapter_tree(lines, chapters):
+        "Return the nested chapters of the lines of a sale"
+        tree = []
+        nodes = {}
+        for line in lines:
+            chapter, amount = chapters[line.id]
+            if line.type in ('title', 'subtitle'):
+                node = nodes[line.id] = {
+                    'id': line.id,
+                    'type': line.type,
+                    'level': _get_level(line),
+                    'description': line.description,
+                    'lines': 0,
+                    'total': amount,
+                    'children': [],
+                    }
+                if chapter:
+                    nodes[chapter]['children'].append(node)
+                else:
+                    tree.append(node)
+            elif line.type == 'line' and chapter:
+                nodes[chapter]['lines'] += 1
+        # Children always follow their parent
+        for line in reversed(lines):
+            if line.id in nodes:
+                chapter, _ = chapters[line.id]
+                if chapter:
+                    nodes[chapter]['lines'] += nodes[line.id]['lines']
+        return tree
+
+    @classmethod
+    def _get_sales_chapters(cls, sale_ids):
+        """Return the line snapshots and the chapters of the sales
+
+        The structures are cached for the transaction.
+        """
+        cache = ChaptersCache.get_cache()
+        structures = {}
+        missing = []
+        for sale_id in sale_ids:
+            structure = cache.get(sale_id)
+            if structure is None:
+                missing.append(sale_id)
+            else:
+                structures[sale_id] = structure
+        if missing:
+            for sale_id, lines in cls._get_snapshots(missing).items():
+                structure = (lines, cls._get_chapters(lines))
+                structures[sale_id] = structure
+                cache.set(sale_id, structure)
+        return structures
+
+    @classmethod
+    def _update_chapters(cls, sales):
+        "Store the chapter and chapter amount of the lines of the sales"
+        to_write = []
+        structures = cls._get_sales_chapters([s.id for s in sales])
+        for lines, chapters in structures.values():
+            for line in lines:
+                chapter, amount = chapters[line.id]
+                if line.chapter != chapter or line.chapter_amount != amount:
+                    to_write.append((line, {
+                                'chapter': chapter,
+                                'chapter_amount': amount,
+                                }))
+                    line.chapter, line.chapter_amount = chapter, amount
+        if to_write:
+            super(SaleLine, cls).write(*cls._get_snapshot_actions(to_write))
+
+    @classmethod
+    def _get_snapshot_actions(cls, to_write):
+        '''Return the write actions of the list of line snapshots and values
+
+        The records are browsed together so they share their prefetching
+        and they get the sale and the type of their snapshot, so write does
+        not read them line by line.
+        '''
+        records = cls.browse([l.id for l, _ in to_write])
+        actions = []
+        for record, (line, values) in zip(records, to_write):
+            record.sale = line.sale
+            record.type = line.type
+            actions.extend(([record], values))
+        return actions
+
+    @classmethod
+    def _get_closing_subtotals(cls, headings):
+        "Return the subtotal lines that close the title and subtitle lines"
+        closings = cls.search([
+                ('chapter', 'in', [h.id for h in headings]),
+                ('type', 'in', list(_CLOSING_TYPES.values())),
+                ])
+        return [l for l in closings
+            if l.type == _CLOSING_TYPES.get(l.chapter.type)]
+
+    @classmethod
+    def _update_subtotal_descriptions(cls, sales):
+        '''Rename the generated subtotal lines of the sales after the heading
+        they close
+
+        Only the lines with the generated prefix are renamed, so the
+        descriptions entered by the user are kept.
+        '''
+        prefix = gettext('sale_subchapters.subtotal_prefix')
+        to_write = []
+        structures = cls._get_sales_chapters([s.id for s in sales])
+        for lines, chapters in structures.values():
+            headings = {l.id: l for l in lines if l.type in _CLOSING_TYPES}
+            for line in lines:
+                heading = headings.get(chapters[line.id][0])
+                if (not heading
+                        or line.type != _CLOSING_TYPES[heading.type]
+                        or not (line.description or '').startswith(
+                            prefix + ' ')):
+                    continue
+                description = '%s %s' % (prefix, heading.description)
+                if line.description != description:
+                    to_write.append((line, {'description': description}))
+        if to_write:
+            cls.write(*cls._get_snapshot_actions(to_write))
+
+    @classmethod
+    def _chapter_sales(cls, lines):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        return Sale.browse({l.sale.id for l in lines if l.sale})
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        cache = ChaptersCache.get_cache()
+        # The new lines may be read by the validation inside create
+        cache.invalidate({v['sale'] for v in vlist if v.get('sale')})
+        lines = super(SaleLine, cls).create(vlist)
+        sales = cls._chapter_sales(lines)
+        cache.invalidate([s.id for s in sales])
+        if Transaction().context.get('_sale_chapters_update', True):
+            cls._update_chapters(sales)
+        Sale._subtotals_outdated({l.sale.id for l in lines
+                if l.sale and l.type in _CLOSING_TYPES})
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        modified, sales, outdated = set(), set(), set()
+        retyped = []
+        actions = iter(args)
+        for lines, values in zip(actions, actions):
+            sale_ids = {l.sale.id for l in lines if l.sale}
+            if values.get('sale'):
+                sale_ids.add(values['sale'])
+            modified |= sale_ids
+            if values.keys() & _CHAPTER_FIELDS:
+                sales |= sale_ids
+            if values.keys() & _HEADING_FIELDS:
+                type_ = values.get('type')
+                for line in lines:
+                    if (line.type not in _CLOSING_TYPES
+                            and type_ not in _CLOSING_TYPES):
+                        continue
+                    outdated |= sale_ids
+                    if ('type' in values and line.type != type_
+                            and line.type in _CLOSING_TYPES
+                            and line.sale and line.sale._auto_subtotals()):
+                        retyped.append(line)
+        # The subtotals of the former type are found before the chapters move
+        closings = cls._get_closing_subtotals(retyped) if retyped else []
+        super(SaleLine, cls).write(*args)
+        ChaptersCache.get_cache().invalidate(modified)
+        if Transaction().context.get('_sale_chapters_update', True):
+            cls._update_chapters(Sale.browse(sales))
+        if closings:
+            cls.delete(closings)
+        Sale._subtotals_outdated(outdated)
+
+    @classmethod
+    def delete(cls, lines):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        headings = [l for l in lines if l.type in _CLOSING_TYPES
+            and l.sale and l.sale._auto_subtotals()]
+        outdated = {l.sale.id for l in headings}
+        if headings:
+            closings = set(cls._get_closing_subtotals(headings))
+            lines = list(lines) + list(closings.difference(lines))
+        sales = cls._chapter_sales(lines)
+        super(SaleLine, cls).delete(lines)
+        ChaptersCache.get_cache().invalidate([s.id for s in sales])
+        cls._update_chapters(sales)
+        Sale._subtotals_outdated(outdated)
+
+    @classmethod
+    def check_modification(cls, mode, lines, values=None, external=False):
+        super(SaleLine, cls).check_modification(
+            mode, lines, values=values, external=external)
+        if Transaction().context.get('_sale_subtotals_process'):
+            return
+        for line in lines:
+            if line.sale and line.sale.subtotals_queued:
+                raise AccessError(gettext(
+                        'sale_subchapters.msg_sale_subtotals_queued',
+                        sale=line.sale.rec_name))
+
+    @classmethod
+    def copy(cls, lines, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        default.setdefault('chapter', None)
+        default.setdefault('chapter_lines', None)
+        default.setdefault('chapter_amount', None)
+        return super(SaleLine, cls).copy(lines, default=default)
+
+    def get_invoice_line(self):
+        # Chapter lines are added by Sale.create_invoice
+        if self.type in _CHAPTER_TYPES:
+            return []
+        return super(SaleLine, self).get_invoice_line()
+
+    def get_chapter_invoice_line(self):
+        "Return the invoice line that reproduces the chapter line"
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        invoice_line = InvoiceLine()
+        invoice_line.invoice_type = 'out'
+        invoice_line.type = self.type
+        invoice_line.currency = self.currency
+        invoice_line.company = self.company
+        invoice_line.description = self.description
+        invoice_line.origin = self
+        return invoice_line
 
     def get_subtotal(self, sequence):
         Line = Pool().get('sale.line')
@@ -77,6 +77,7 @@ setup(name='%s_%s' % (PREFIX, MODULE),
         'trytond.modules.%s' % MODULE,
         'trytond.modules.%s.tests' % MODULE,
         ],
+    scripts=['bin/trytond-sale-subtotals'],
     package_data={
         'trytond.modules.%s' % MODULE: (info.get('xml', [])
             + ['tryton.cfg', 'view/*.xml', 'locale/*.po', 'tests/*.rst']),
@@ -0,0 +1,120 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.model import ModelSQL, ModelView, fields, sequence_ordered
+from trytond.modules.product import price_digits
+from trytond.pool import Pool
+from trytond.pyson import Eval, If
+from trytond.wizard import Button, StateTransition, StateView, Wizard
+
+__all__ = ['ChapterTemplate', 'ChapterTemplateLine',
+    'InsertChapterTemplateStart', 'InsertChapterTemplate']
+
+
+class ChapterTemplate(ModelSQL, ModelView):
+    "Sale Chapter Template"
+    __name__ = 'sale.chapter.template'
+    name = fields.Char("Name", required=True, translate=True)
+    lines = fields.One2Many('sale.chapter.template.line', 'template',
+        "Lines")
+
+
+class ChapterTemplateLine(sequence_ordered(), ModelSQL, ModelView):
+    "Sale Chapter Template Line"
+    __name__ = 'sale.chapter.template.line'
+    template = fields.Many2One('sale.chapter.template', "Template",
+        required=True, ondelete='CASCADE')
+    type = fields.Selection([
+            ('line', "Line"),
+            ('title', "Title"),
+            ('subtitle', "Subtitle"),
+            ('comment', "Comment"),
+            ], "Type", required=True)
+    chapter_level = fields.Integer("Level",
+        domain=[
+            If(Eval('type') == 'subtitle',
+                ['OR',
+                    ('chapter_level', '=', None),
+                    ('chapter_level', '>=', 2),
+                    ],
+                []),
+            ],
+        states={
+            'invisible': Eval('type') != 'subtitle',
+            },
+        help="The nesting level of the subtitle, 2 being directly under "
+        "the title.\n"
+        "Leave empty for 2.")
+    description = fields.Text("Description")
+    product = fields.Many2One('product.product', "Product",
+        domain=[
+            ('salable', '=', True),
+            ],
+        states={
+            'invisible': Eval('type') != 'line',
+            })
+    quantity = fields.Float("Quantity",
+        states={
+            'invisible': Eval('type') != 'line',
+            })
+    unit_price = fields.Numeric("Unit Price", digits=price_digits,
+        states={
+            'invisible': Eval('type') != 'line',
+            },
+        help="Leave empty to use the price of the product.")
+
+    @staticmethod
+    def default_type():
+        return 'line'
+
+    def get_sale_line(self, sale):
+        "Return the sale line of the template line for the sale"
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        line = SaleLine(sale=sale, type=self.type)
+        if self.type == 'subtitle':
+            line.chapter_level = self.chapter_level
+        elif self.type == 'line':
+            line.quantity = self.quantity
+            if self.product:
+                line.product = self.product
+                line.on_change_product()
+            if self.unit_price is not None:
+                line.unit_price = self.unit_price
+        if self.description:
+            line.description = self.description
+        return line
+
+
+class InsertChapterTemplateStart(ModelView):
+    "Insert Chapter Template"
+    __name__ = 'sale.chapter.template.insert.start'
+    sale = fields.Many2One('sale.sale', "Sale", readonly=True)
+    template = fields.Many2One('sale.chapter.template', "Template",
+        required=True)
+    after = fields.Many2One('sale.line', "After",
+        domain=[
+            ('sale', '=', Eval('sale', -1)),
+            ],
+        help="Insert the template after this line.\n"
+        "Leave empty to insert it at the end of the sale.")
+
+
+class InsertChapterTemplate(Wizard):
+    "Insert Chapter Template"
+    __name__ = 'sale.chapter.template.insert'
+    start = StateView('sale.chapter.template.insert.start',
+        'sale_subchapters.chapter_template_insert_start_view_form', [
+            Button("Cancel", 'end', 'tryton-cancel'),
+            Button("Insert", 'insert', 'tryton-ok', default=True),
+            ])
+    insert = StateTransition()
+
+    def default_start(self, fields):
+        return {
+            'sale': self.record.id,
+            }
+
+    def transition_insert(self):
+        self.record.insert_chapter_template(
+            self.start.template, after=self.start.after)
+        return 'end'
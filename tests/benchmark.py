@@ -0,0 +1,252 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""Benchmark of the subchapter operations on large sales
+
+Builds synthetic sales against the test database (SQLite by default) and
+reports, for each size and chapter layout, the wall time, the number of SQL
+statements and the peak memory of:
+
+    - reading the amount of all the lines
+    - update_subtotals
+    - confirming and invoicing the sale
+
+Run it with:
+
+    python -m trytond.modules.sale_subchapters.tests.benchmark \\
+        --sizes 100 1000 10000 --save baseline.json
+
+and compare a later run against the stored baseline with --baseline; the
+exit status is 1 when a measure regresses beyond the tolerance.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from decimal import Decimal
+
+os.environ.setdefault('TRYTOND_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('DB_NAME', ':memory:')
+
+from trytond.config import config  # noqa: E402
+from trytond.modules.account.tests import create_chart  # noqa: E402
+from trytond.modules.company.tests import (  # noqa: E402
+    create_company, set_company)
+from trytond.modules.sale_subchapters.instrument import (  # noqa: E402
+    counters, instrument)
+from trytond.pool import Pool  # noqa: E402
+from trytond.tests.test_tryton import (  # noqa: E402
+    activate_module, with_transaction)
+
+MODULE = 'sale_subchapters'
+LAYOUTS = ['flat', 'titles', 'nested']
+OPERATIONS = ['get_amount', 'update_subtotals', 'confirm_invoice']
+
+
+class Measure(object):
+    """Measure wall time, SQL statements and peak memory of a block
+
+    The statements are counted by the instrumentation of the module under
+    the operation name, so it works on any backend.
+    """
+
+    def __init__(self, operation):
+        self.operation = operation
+
+    def __enter__(self):
+        self._stats = instrument('benchmark %s' % self.operation)
+        self._stats.__enter__()
+        self._queries = counters[self._stats.operation]['queries']
+        tracemalloc.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.time = time.perf_counter() - self.start
+        _, self.memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self._stats.__exit__(type, value, traceback)
+        self.queries = (counters[self._stats.operation]['queries']
+            - self._queries)
+
+    def result(self):
+        return {
+            'time': round(self.time, 4),
+            'queries': self.queries,
+            'memory': self.memory,
+            }
+
+
+def iter_lines(size, layout):
+    "Yield the type of the lines of a synthetic sale of size lines"
+    if layout == 'flat':
+        for _ in range(size):
+            yield 'line'
+        return
+    count = 0
+    while count < size:
+        yield 'title'
+        count += 1
+        for _ in range(4 if layout == 'nested' else 1):
+            if layout == 'nested':
+                yield 'subtitle'
+                count += 1
+            for _ in range(10):
+                yield 'line'
+                count += 1
+
+
+def setup_company():
+    pool = Pool()
+    Account = pool.get('account.account')
+    AccountConfiguration = pool.get('account.configuration')
+    Party = pool.get('party.party')
+    PaymentTerm = pool.get('account.invoice.payment_term')
+
+    company = create_company()
+    with set_company(company):
+        create_chart(company)
+        receivable, = Account.search([
+                ('type.receivable', '=', True),
+                ], limit=1)
+        revenue, = Account.search([
+                ('type.revenue', '=', True),
+                ('closed', '!=', True),
+                ('childs', '=', None),
+                ], limit=1)
+        config = AccountConfiguration(1)
+        config.default_category_account_revenue = revenue
+        config.save()
+        payment_term, = PaymentTerm.create([{
+                    'name': 'Direct',
+                    'lines': [('create', [{'type': 'remainder'}])]
+                    }])
+        customer, = Party.create([{
+                    'name': 'customer',
+                    'addresses': [('create', [{}])],
+                    'account_receivable': receivable.id,
+                    'customer_payment_term': payment_term.id,
+                    }])
+    return company, customer, payment_term
+
+
+def create_sale(company, customer, payment_term, size, layout):
+    pool = Pool()
+    Sale = pool.get('sale.sale')
+
+    lines = []
+    for type_ in iter_lines(size, layout):
+        values = {
+            'type': type_,
+            'description': '%s %s' % (type_.capitalize(), len(lines)),
+            }
+        if type_ == 'line':
+            values['quantity'] = 1
+            values['unit_price'] = Decimal('10.00')
+        lines.append(values)
+    sale, = Sale.create([{
+                'company': company.id,
+                'party': customer.id,
+                'invoice_address': customer.addresses[0].id,
+                'shipment_address': customer.addresses[0].id,
+                'currency': company.currency.id,
+                'payment_term': payment_term.id,
+                'invoice_method': 'order',
+                'shipment_method': 'manual',
+                'lines': [('create', lines)],
+                }])
+    return sale
+
+
+@with_transaction()
+def run(size, layout):
+    pool = Pool()
+    Sale = pool.get('sale.sale')
+    SaleLine = pool.get('sale.line')
+
+    company, customer, payment_term = setup_company()
+    results = {}
+    with set_company(company):
+        sale = create_sale(company, customer, payment_term, size, layout)
+
+        with Measure('update_subtotals') as measure:
+            Sale.update_subtotals([sale])
+        results['update_subtotals'] = measure.result()
+
+        line_ids = [l.id for l in Sale(sale.id).lines]
+        with Measure('get_amount') as measure:
+            SaleLine.read(line_ids, ['amount'])
+        results['get_amount'] = measure.result()
+
+        sale = Sale(sale.id)
+        with Measure('confirm_invoice') as measure:
+            Sale.quote([sale])
+            Sale.confirm([sale])
+            Sale.process([sale])
+        results['confirm_invoice'] = measure.result()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    "Return the list of measures that regressed against the baseline"
+    regressions = []
+    for key, operations in results.items():
+        for operation, measures in operations.items():
+            reference = baseline.get(key, {}).get(operation)
+            if not reference:
+                continue
+            for measure in ['time', 'queries', 'memory']:
+                if measures[measure] > reference[measure] * (1 + tolerance):
+                    regressions.append((key, operation, measure,
+                            reference[measure], measures[measure]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the subchapter operations on large sales")
+    parser.add_argument('--sizes', nargs='+', type=int,
+        default=[100, 1000, 10000], help="number of lines of the sales")
+    parser.add_argument('--layouts', nargs='+', choices=LAYOUTS,
+        default=LAYOUTS, help="chapter layouts of the sales")
+    parser.add_argument('--baseline', help="JSON file to compare with")
+    parser.add_argument('--save', help="JSON file to store the results in")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help="allowed relative increase over the baseline")
+    options = parser.parse_args(argv)
+
+    if not config.has_section('sale_subchapters'):
+        config.add_section('sale_subchapters')
+    config.set('sale_subchapters', 'instrument', 'True')
+    activate_module(MODULE)
+
+    results = {}
+    for layout in options.layouts:
+        for size in options.sizes:
+            key = '%s-%s' % (layout, size)
+            results[key] = run(size, layout)
+            for operation in OPERATIONS:
+                measures = results[key][operation]
+                print('%-14s %-18s %10.4fs %8d queries %12d bytes' % (
+                        key, operation, measures['time'],
+                        measures['queries'], measures['memory']))
+
+    if options.save:
+        with open(options.save, 'w') as file_:
+            json.dump(results, file_, indent=2, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as file_:
+            baseline = json.load(file_)
+        regressions = compare(results, baseline, options.tolerance)
+        for key, operation, measure, reference, value in regressions:
+            print('REGRESSION %s %s %s: %s -> %s' % (
+                    key, operation, measure, reference, value))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
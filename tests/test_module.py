@@ -2,12 +2,26 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
+import datetime
+import logging
+from copy import deepcopy
 from decimal import Decimal
+from unittest.mock import patch
+
+from trytond.model.exceptions import AccessError, ValidationError
 from trytond.pool import Pool
-from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.pyson import PYSONDecoder, PYSONEncoder
+from trytond.tests.test_tryton import (ModuleTestCase, with_transaction,
+    CONTEXT, DB_NAME)
+from trytond.transaction import Transaction, _TransactionLockRecordsError
 from trytond.modules.company.tests import (create_company, set_company,
     CompanyTestMixin)
 from trytond.modules.account.tests import create_chart
+from trytond.modules.sale_subchapters.importer import read_rows
+from trytond.modules.sale_subchapters.instrument import (counters,
+    logger as instrument_logger)
+from trytond.modules.sale_subchapters.runner import get_sale_ids, update_sale
+from trytond.modules.sale_subchapters.sale import ChaptersCache
 
 
 class SaleSubchaptersTestCase(CompanyTestMixin, ModuleTestCase):
@@ -48,6 +62,31 @@ class SaleSubchaptersTestCase(CompanyTestMixin, ModuleTestCase):
         if suffix:
             sale_line.description += suffix
 
+    def create_customer(self, company):
+        "Create the chart of accounts of the company and a customer"
+        pool = Pool()
+        Account = pool.get('account.account')
+        Party = pool.get('party.party')
+        PaymentTerm = pool.get('account.invoice.payment_term')
+
+        create_chart(company)
+        receivable, = Account.search([
+                ('type.receivable', '=', True),
+                ], limit=1)
+        payment_term, = PaymentTerm.create([{
+                    'name': 'Direct',
+                    'lines': [('create', [{'type': 'remainder'}])]
+                    }])
+        customer, = Party.create([{
+                    'name': 'customer',
+                    'addresses': [
+                        ('create', [{}]),
+                        ],
+                    'account_receivable': receivable.id,
+                    'customer_payment_term': payment_term.id,
+                    }])
+        return customer, payment_term
+
     @with_transaction()
     def test0010subsubtotal_amount(self):
         'Test subsubtotal line amount'
@@ -55,6 +94,8 @@ class SaleSubchaptersTestCase(CompanyTestMixin, ModuleTestCase):
         Account = pool.get('account.account')
         Party = pool.get('party.party')
         PaymentTerm = pool.get('account.invoice.payment_term')
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
 
         # Create Company
         party = Party(name='Party')
@@ -158,6 +199,15 @@ class SaleSubchaptersTestCase(CompanyTestMixin, ModuleTestCase):
             self.assertEqual(sale4.lines[-2].amount, Decimal('50'))
             self.assertEqual(sale4.lines[-1].amount, Decimal('60'))
 
+            # Amounts follow the changes of the lines in the same transaction
+            SaleLine.write([sale4.lines[2]], {'quantity': 3})
+            sale4 = Sale(sale4.id)
+            self.assertEqual(sale4.lines[4].amount, Decimal('40'))
+            self.assertEqual(sale4.lines[10].amount, Decimal('70'))
+            SaleLine.delete([sale4.lines[3]])
+            sale4 = Sale(sale4.id)
+            self.assertEqual(sale4.lines[3].amount, Decimal('30'))
+
     @with_transaction()
     def test0020update_subtotals(self):
         'Test update_subtotals'
@@ -297,6 +347,838 @@ class SaleSubchaptersTestCase(CompanyTestMixin, ModuleTestCase):
             check_subtotal(sale3, -2, 'subsubtotal', ' A.1', Decimal('20.00'))
             check_subtotal(sale3, -1, 'subtotal', ' A', Decimal('30.00'))
 
+    def test0030gapped_sequences(self):
+        'Test gapped_sequences'
+        from trytond.modules.sale_subchapters.sale import gapped_sequences
+
+        self.assertEqual(gapped_sequences([None, None, None]), [10, 20, 30])
+        # New lines only take the free room between their neighbours
+        self.assertEqual(
+            gapped_sequences([10, 20, None, 30, 40]), [10, 20, 25, 30, 40])
+        self.assertEqual(
+            gapped_sequences([10, None, None, 40]), [10, 20, 30, 40])
+        # When a gap runs out only the following lines are renumbered
+        self.assertEqual(
+            gapped_sequences([10, 11, None, 12, 30]), [10, 11, 17, 23, 30])
+        self.assertEqual(gapped_sequences([5, 5, None]), [5, 15, 25])
+        # Dense sequences are spaced once and leave room afterwards
+        sequences = gapped_sequences([1, 2, None, 3, 4, 5])
+        self.assertEqual(sequences, [1, 2, 12, 22, 32, 42])
+        self.assertEqual(
+            gapped_sequences(sequences[:4] + [None] + sequences[4:]),
+            [1, 2, 12, 22, 27, 32, 42])
+
+    @with_transaction()
+    def test0040chapter_summary(self):
+        'Test get_chapter_summary'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            customer, payment_term = self.create_customer(company)
+
+            # Summary without any subtotal line generated
+            sale = self.create_sale(company, customer, payment_term)
+            sale.sale_date = datetime.date(2024, 3, 15)
+            self.create_sale_line(sale, 'title', suffix=' A')
+            self.create_sale_line(sale, 'subtitle', suffix=' A.1')
+            self.create_sale_line(sale, 'line')
+            self.create_sale_line(sale, 'line')
+            self.create_sale_line(sale, 'subtitle', suffix=' A.2')
+            self.create_sale_line(sale, 'line')
+            self.create_sale_line(sale, 'title', suffix=' B')
+            self.create_sale_line(sale, 'line')
+            sale.save()
+
+            summary, = Sale.get_chapter_summary([sale])
+            self.assertEqual(summary['id'], sale.id)
+
+            def simplify(chapters):
+                return [(c['description'], c['lines'], c['total'],
+                        simplify(c['children'])) for c in chapters]
+            self.assertEqual(simplify(summary['chapters']), [
+                    ('Title line A', 3, Decimal('30'), [
+                            ('Title line A.1', 2, Decimal('20'), []),
+                            ('Title line A.2', 1, Decimal('10'), []),
+                            ]),
+                    ('Title line B', 1, Decimal('10'), []),
+                    ])
+
+    @with_transaction()
+    def test0050on_change_chapter_amounts(self):
+        'Test subtotal amounts are updated by on_change_lines'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            sale = Sale(company=company, currency=company.currency)
+
+            def line(type_, unit_price=None, amount=None):
+                line = SaleLine(sale=sale, type=type_, amount=amount)
+                if type_ == 'line':
+                    line.quantity = 1
+                    line.unit_price = unit_price
+                    line.amount = line.on_change_with_amount()
+                return line
+
+            sale.lines = [
+                line('title'),
+                line('subtitle'),
+                line('line', Decimal('10')),
+                line('line', Decimal('30')),
+                line('subsubtotal', amount=Decimal('20')),
+                line('subtitle'),
+                line('line', Decimal('5')),
+                line('subsubtotal', amount=Decimal('5')),
+                line('subtotal', amount=Decimal('25')),
+                ]
+            self.assertIsNone(sale.id)
+            sale.on_change_lines()
+            self.assertEqual(
+                [l.amount for l in sale.lines if l.type != 'line'],
+                [None, None, Decimal('40'), None, Decimal('5'),
+                    Decimal('45')])
+
+    @with_transaction()
+    def test0060auto_subtotals(self):
+        'Test subtotals are maintained automatically'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        company.sale_subtotals_auto = True
+        company.save()
+        with set_company(company):
+            customer, payment_term = self.create_customer(company)
+
+            def layout(sale):
+                sale = Sale(sale.id)
+                return [(l.type, l.description) for l in sale.lines]
+
+            # Subtotals are generated when the sale is saved
+            sale = self.create_sale(company, customer, payment_term)
+            sale.sale_date = datetime.date(2024, 3, 15)
+            self.create_sale_line(sale, 'title', suffix=' A')
+            self.create_sale_line(sale, 'subtitle', suffix=' A.1')
+            self.create_sale_line(sale, 'line')
+            self.create_sale_line(sale, 'title', suffix=' B')
+            self.create_sale_line(sale, 'line')
+            sale.save()
+            self.assertEqual(layout(sale), [
+                    ('title', 'Title line A'),
+                    ('subtitle', 'Title line A.1'),
+                    ('line', 'Normal line'),
+                    ('subsubtotal', 'Subtotal Title line A.1'),
+                    ('subtotal', 'Subtotal Title line A'),
+                    ('title', 'Title line B'),
+                    ('line', 'Normal line'),
+                    ('subtotal', 'Subtotal Title line B'),
+                    ])
+
+            # Renaming a heading renames its subtotal
+            sale = Sale(sale.id)
+            SaleLine.write([sale.lines[1]], {'description': 'Renamed'})
+            self.assertEqual(layout(sale)[3],
+                ('subsubtotal', 'Subtotal Renamed'))
+
+            # Deleting a heading deletes its subtotal
+            sale = Sale(sale.id)
+            SaleLine.delete([sale.lines[5]])
+            self.assertEqual(layout(sale), [
+                    ('title', 'Title line A'),
+                    ('subtitle', 'Renamed'),
+                    ('line', 'Normal line'),
+                    ('subsubtotal', 'Subtotal Renamed'),
+                    ('subtotal', 'Subtotal Title line A'),
+                    ('line', 'Normal line'),
+                    ])
+
+    @with_transaction()
+    def test0070import_lines(self):
+        'Test import_lines'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            customer, payment_term = self.create_customer(company)
+
+            sale = self.create_sale(company, customer, payment_term)
+            sale.save()
+            rows = read_rows(b'level,description,quantity,unit_price\n'
+                b'1,A,,\n'
+                b'2,A.1,,\n'
+                b',Line,2,10\n'
+                b',B,,\n'
+                b',Line,1,5\n')
+            self.assertEqual(sale.import_lines(rows, batch_size=2), 8)
+
+            sale = Sale(sale.id)
+            self.assertEqual([(l.type, l.description) for l in sale.lines], [
+                    ('title', 'A'),
+                    ('subtitle', 'A.1'),
+                    ('line', 'Line'),
+                    ('subsubtotal', 'Subtotal A.1'),
+                    ('subtotal', 'Subtotal A'),
+                    ('title', 'B'),
+                    ('line', 'Line'),
+                    ('subtotal', 'Subtotal B'),
+                    ])
+            self.assertEqual(
+                [sale.lines[i].amount for i in [3, 4, 7]],
+                [Decimal('20.00'), Decimal('20.00'), Decimal('5.00')])
+            self.assertEqual(sale.lines[0].chapter_amount, Decimal('20.00'))
+
+    @with_transaction()
+    def test0080insert_chapter_template(self):
+        'Test insert_chapter_template'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Template = pool.get('sale.chapter.template')
+
+        company = create_company()
+        with set_company(company):
+            customer, payment_term = self.create_customer(company)
+            template, = Template.create([{
+                        'name': 'Template',
+                        'lines': [('create', [{
+                                        'type': 'title',
+                                        'description': 'T',
+                                        }, {
+                                        'type': 'subtitle',
+                                        'description': 'T.1',
+                                        }, {
+                                        'type': 'line',
+                                        'description': 'Line',
+                                        'quantity': 2,
+                                        'unit_price': Decimal('10'),
+                                        }])],
+                        }])
+
+            sale = self.create_sale(company, customer, payment_term)
+            self.create_sale_line(sale, 'title', suffix=' A')
+            self.create_sale_line(sale, 'line')
+            self.create_sale_line(sale, 'title', suffix=' B')
+            self.create_sale_line(sale, 'line')
+            sale.save()
+            Sale.update_subtotals([sale])
+            sale = Sale(sale.id)
+            sequences = [l.sequence for l in sale.lines]
+
+            sale.insert_chapter_template(template, after=sale.lines[2])
+            sale = Sale(sale.id)
+            self.assertEqual([(l.type, l.description) for l in sale.lines], [
+                    ('title', 'Title line A'),
+                    ('line', 'Normal line'),
+                    ('subtotal', 'Subtotal Title line A'),
+                    ('title', 'T'),
+                    ('subtitle', 'T.1'),
+                    ('line', 'Line'),
+                    ('subsubtotal', 'Subtotal T.1'),
+                    ('subtotal', 'Subtotal T'),
+                    ('title', 'Title line B'),
+                    ('line', 'Normal line'),
+                    ('subtotal', 'Subtotal Title line B'),
+                    ])
+            self.assertEqual(
+                [l.sequence for i, l in enumerate(sale.lines)
+                    if i not in range(3, 8)], sequences)
+            self.assertEqual(sale.lines[3].chapter_amount, Decimal('20.00'))
+
+            # Inside a chapter the template is nested and does not close it
+            sale.insert_chapter_template(template, after=sale.lines[9])
+            sale = Sale(sale.id)
+            self.assertEqual(
+                [(l.type, l.chapter_level, l.description)
+                    for l in sale.lines[8:]], [
+                    ('title', None, 'Title line B'),
+                    ('line', None, 'Normal line'),
+                    ('subtitle', 2, 'T'),
+                    ('subtitle', 3, 'T.1'),
+                    ('line', None, 'Line'),
+                    ('subsubtotal', None, 'Subtotal T.1'),
+                    ('subsubtotal', None, 'Subtotal T'),
+                    ('subtotal', None, 'Subtotal Title line B'),
+                    ])
+            self.assertEqual(sale.lines[8].chapter_amount, Decimal('30.00'))
+            self.assertEqual(sale.lines[14].amount, Decimal('20.00'))
+            self.assertEqual(sale.lines[15].amount, Decimal('30.00'))
+
+    def test0090nested_chapters(self):
+        'Test chapters nested on several levels'
+        from trytond.modules.sale_subchapters.sale import (
+            LineSnapshot, Sale, SaleLine)
+
+        def snapshot(id, type_, level=None, amount=None):
+            return LineSnapshot(id, None, type_, level, id * 10,
+                Decimal(amount) if amount is not None else None,
+                None, None, None)
+
+        lines = [
+            snapshot(1, 'title'),
+            snapshot(2, 'subtitle'),
+            snapshot(3, 'line', amount=10),
+            snapshot(4, 'subtitle', level=3),
+            snapshot(5, 'line', amount=20),
+            snapshot(6, 'subsubtotal'),
+            snapshot(7, 'line', amount=5),
+            snapshot(8, 'subsubtotal'),
+            snapshot(9, 'line', amount=1),
+            snapshot(10, 'subtotal'),
+            ]
+        self.assertEqual(SaleLine._get_chapters(lines), {
+                1: (None, Decimal(36)),
+                2: (1, Decimal(35)),
+                3: (2, None),
+                4: (2, Decimal(20)),
+                5: (4, None),
+                6: (4, Decimal(20)),
+                7: (2, None),
+                8: (2, Decimal(35)),
+                9: (1, None),
+                10: (1, None),
+                })
+        self.assertFalse(
+            [l for l, new, _ in Sale._get_subtotals_layout(lines) if new])
+
+        # The deeper chapters are closed first
+        lines = [lines[i] for i in [0, 1, 2, 3, 4]] + [
+            snapshot(11, 'subtitle'),
+            snapshot(12, 'line', amount=5),
+            ]
+        self.assertEqual(
+            [(l.id, new) for l, new, _ in Sale._get_subtotals_layout(lines)],
+            [(1, False), (2, False), (3, False), (4, False), (5, False),
+                (4, True), (2, True), (11, False), (12, False),
+                (11, True), (1, True)])
+
+    @with_transaction()
+    def test0100sale_chapter(self):
+        'Test sale.chapter'
+        pool = Pool()
+        SaleChapter = pool.get('sale.chapter')
+
+        company = create_company()
+        with set_company(company):
+            customer, payment_term = self.create_customer(company)
+
+            sale = self.create_sale(company, customer, payment_term)
+            sale.sale_date = datetime.date(2024, 3, 15)
+            self.create_sale_line(sale, 'title', suffix=' A')
+            self.create_sale_line(sale, 'subtitle', suffix=' A.1')
+            self.create_sale_line(sale, 'line')
+            self.create_sale_line(sale, 'line')
+            self.create_sale_line(sale, 'title', suffix=' B')
+            self.create_sale_line(sale, 'line')
+            sale.save()
+
+            chapters = SaleChapter.search([
+                    ('company', '=', company.id),
+                    ('party', '=', customer.id),
+                    ('state', '=', 'draft'),
+                    ])
+            self.assertEqual(
+                [(c.type, c.level, c.description, c.total) for c in chapters],
+                [
+                    ('title', 1, 'Title line A', Decimal('20')),
+                    ('subtitle', 2, 'Title line A.1', Decimal('20')),
+                    ('title', 1, 'Title line B', Decimal('10')),
+                    ])
+            self.assertEqual(
+                {c.month for c in chapters}, {datetime.date(2024, 3, 1)})
+            title_a, subtitle_a1, _ = chapters
+            self.assertEqual(subtitle_a1.parent, title_a)
+            self.assertEqual(list(title_a.children), [subtitle_a1])
+
+    @with_transaction()
+    def test0110backfill_chapters(self):
+        'Test the chapters of the existing lines are stored'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            customer, payment_term = self.create_customer(company)
+
+            sale = self.create_sale(company, customer, payment_term)
+            self.create_sale_line(sale, 'title', suffix=' A')
+            self.create_sale_line(sale, 'subtitle', suffix=' A.1')
+            self.create_sale_line(sale, 'line')
+            self.create_sale_line(sale, 'subsubtotal')
+            self.create_sale_line(sale, 'line')
+            self.create_sale_line(sale, 'subtotal')
+            sale.save()
+            sale = Sale(sale.id)
+            expected = [(l.chapter, l.chapter_amount) for l in sale.lines]
+
+            # Lines stored before the columns were added
+            line = SaleLine.__table__()
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*line.update(
+                    [line.chapter, line.chapter_amount], [None, None]))
+            ChaptersCache.get_cache().invalidate([sale.id])
+
+            SaleLine._backfill_chapters()
+            sale = Sale(sale.id)
+            self.assertEqual(
+                [(l.chapter, l.chapter_amount) for l in sale.lines], expected)
+            title, subtitle = sale.lines[:2]
+            self.assertEqual(title.chapter_amount, Decimal('20'))
+            self.assertEqual(subtitle.chapter, title)
+            self.assertEqual(sale.lines[3].chapter_amount, Decimal('10'))
+
+    @with_transaction()
+    def test0120invoice_grouped_sales(self):
+        'Test the chapters of sales grouped in the same invoice'
+        pool = Pool()
+        Account = pool.get('account.account')
+        AccountConfiguration = pool.get('account.configuration')
+        Invoice = pool.get('account.invoice')
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            customer, payment_term = self.create_customer(company)
+            revenue, = Account.search([
+                    ('type.revenue', '=', True),
+                    ('closed', '!=', True),
+                    ('childs', '=', None),
+                    ], limit=1)
+            config = AccountConfiguration(1)
+            config.default_category_account_revenue = revenue
+            config.save()
+
+            sales = []
+            for suffix in [' A', ' B']:
+                sale = self.create_sale(company, customer, payment_term)
+                self.create_sale_line(sale, 'title', suffix=suffix)
+                self.create_sale_line(sale, 'line')
+                self.create_sale_line(sale, 'line')
+                sale.save()
+                sales.append(sale)
+            Sale.update_subtotals(sales)
+            sale_a, sale_b = Sale.browse(sales)
+            sale_b.lines[1].quantity = 2
+            sale_b.lines[1].save()
+
+            invoice = sale_a.create_invoice()
+            invoice.save()
+            with patch.object(
+                    Sale, '_get_invoice_sale', return_value=invoice):
+                invoice = Sale(sale_b.id).create_invoice()
+            invoice.save()
+
+            invoice = Invoice(invoice.id)
+            self.assertEqual(
+                [(l.type, l.description) for l in invoice.lines], [
+                    ('title', 'Title line A'),
+                    ('line', 'Normal line'),
+                    ('line', 'Normal line'),
+                    ('subtotal', 'Subtotal Title line A'),
+                    ('title', 'Title line B'),
+                    ('line', 'Normal line'),
+                    ('line', 'Normal line'),
+                    ('subtotal', 'Subtotal Title line B'),
+                    ])
+            self.assertEqual(
+                [l.amount for l in invoice.lines if l.type == 'subtotal'],
+                [Decimal('20'), Decimal('30')])
+
+    def test0130runner(self):
+        'Test the runner updates each sale in its own transaction'
+        pool = Pool(DB_NAME)
+        Company = pool.get('company.company')
+        Currency = pool.get('currency.currency')
+        Party = pool.get('party.party')
+        PaymentTerm = pool.get('account.invoice.payment_term')
+        Sale = pool.get('sale.sale')
+
+        # The runner starts its own transactions so the data is committed
+        with Transaction().start(DB_NAME, 1, context=CONTEXT) as transaction:
+            company = create_company()
+            with set_company(company):
+                payment_term, = PaymentTerm.create([{
+                            'name': 'Direct',
+                            'lines': [('create', [{'type': 'remainder'}])]
+                            }])
+                customer, = Party.create([{
+                            'name': 'customer',
+                            'addresses': [
+                                ('create', [{}]),
+                                ],
+                            }])
+                sale_ids = []
+                for _ in range(2):
+                    sale = self.create_sale(company, customer, payment_term)
+                    self.create_sale_line(sale, 'title')
+                    self.create_sale_line(sale, 'line')
+                    sale.save()
+                    sale_ids.append(sale.id)
+            company_id = company.id
+            party_ids = [customer.id, company.party.id]
+            payment_term_id = payment_term.id
+            currency_id = company.currency.id
+            transaction.commit()
+
+        try:
+            self.assertEqual(get_sale_ids(
+                    DB_NAME, [('company', '=', company_id)]), sale_ids)
+            sale1_id, sale2_id = sale_ids
+            self.assertEqual(
+                update_sale(DB_NAME, sale1_id), (sale1_id, 0, True))
+
+            # The transaction is restarted when the lock is not available
+            lock = Sale.lock
+            calls = []
+
+            def lock_once(records=None):
+                calls.append(records)
+                if len(calls) == 1:
+                    raise _TransactionLockRecordsError(
+                        Sale._table, [sale2_id])
+                return lock(records)
+            with patch.object(Sale, 'lock', side_effect=lock_once):
+                self.assertEqual(
+                    update_sale(DB_NAME, sale2_id), (sale2_id, 0, True))
+            self.assertGreater(len(calls), 1)
+
+            with Transaction().start(DB_NAME, 0, context=CONTEXT):
+                for sale in Sale.browse(sale_ids):
+                    self.assertEqual(
+                        [l.type for l in sale.lines],
+                        ['title', 'line', 'subtotal'])
+        finally:
+            # Remove the committed data from the database shared by the tests
+            with Transaction().start(
+                    DB_NAME, 0, context=CONTEXT) as transaction:
+                with set_company(Company(company_id)):
+                    Sale.delete(Sale.browse(sale_ids))
+                Company.delete([Company(company_id)])
+                Party.delete(Party.browse(party_ids))
+                PaymentTerm.delete([PaymentTerm(payment_term_id)])
+                Currency.delete([Currency(currency_id)])
+                transaction.commit()
+
+    @with_transaction()
+    def test0140queue_subtotals(self):
+        'Test the subtotals of large sales are updated in the background'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Queue = pool.get('ir.queue')
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            customer, payment_term = self.create_customer(company)
+            company.sale_subtotals_queue_threshold = 6
+            company.save()
+
+            sale = self.create_sale(company, customer, payment_term)
+            for suffix in [' A', ' B', ' C']:
+                self.create_sale_line(sale, 'title', suffix=suffix)
+                self.create_sale_line(sale, 'line')
+            for i, line in enumerate(sale.lines, 1):
+                line.sequence = i * 10
+            sale.save()
+
+            Sale.update_subtotals([sale])
+            sale = Sale(sale.id)
+            self.assertTrue(sale.subtotals_queued)
+            self.assertEqual(
+                (sale.subtotals_processed, sale.subtotals_lines), (0, 6))
+            self.assertEqual(len(sale.lines), 6)
+            with self.assertRaises(AccessError):
+                SaleLine.write([sale.lines[1]], {'quantity': 2})
+
+            # The queued sale is not updated nor queued again
+            tasks = Queue.search([], count=True)
+            Sale.update_subtotals([sale])
+            Sale.update_draft_subtotals()
+            self.assertEqual(Queue.search([], count=True), tasks)
+            self.assertEqual(len(Sale(sale.id).lines), 6)
+
+            # Each task stores its progress until the sale is finished
+            Sale._process_subtotals([sale], size=4)
+            sale = Sale(sale.id)
+            self.assertTrue(sale.subtotals_queued)
+            self.assertEqual(
+                (sale.subtotals_processed, sale.subtotals_lines), (4, 9))
+            self.assertEqual(
+                [l.type for l in sale.lines],
+                ['title', 'line', 'subtotal', 'title', 'line', 'title',
+                    'line'])
+
+            Sale.process_subtotals([sale])
+            sale = Sale(sale.id)
+            self.assertFalse(sale.subtotals_queued)
+            self.assertEqual(
+                (sale.subtotals_processed, sale.subtotals_lines), (9, 9))
+            self.assertEqual(
+                [l.type for l in sale.lines],
+                ['title', 'line', 'subtotal'] * 3)
+
+    @with_transaction()
+    def test0150sql_amounts(self):
+        'Test the amounts computed by the database'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            customer, payment_term = self.create_customer(company)
+
+            sale = self.create_sale(company, customer, payment_term)
+            for type_, quantity, unit_price in [
+                    ('title', None, None),
+                    ('subtitle', None, None),
+                    ('line', 1, '0.125'),
+                    ('line', 3, '0.125'),
+                    ('subsubtotal', None, None),
+                    ('line', 1, '2.675'),
+                    ('subtotal', None, None),
+                    ('line', 2, '10'),
+                    ('subsubtotal', None, None),
+                    ]:
+                self.create_sale_line(sale, type_)
+                if type_ == 'line':
+                    sale.lines[-1].quantity = quantity
+                    sale.lines[-1].unit_price = Decimal(unit_price)
+            sale.save()
+            sale = Sale(sale.id)
+
+            # The database computes the amounts of the subsubtotals too
+            line = SaleLine.__table__()
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*line.update(
+                    [line.chapter_amount], [None],
+                    where=line.type == 'subsubtotal'))
+            lines = SaleLine.browse([l.id for l in sale.lines])
+            amounts = {l.id: l.amount for l in lines}
+            self.assertEqual(SaleLine._get_sql_amounts(lines), amounts)
+            self.assertEqual(
+                [amounts[l.id] for l in lines if l.type != 'line'], [
+                    Decimal('0'), Decimal('0'), Decimal('0.50'),
+                    Decimal('3.18'), Decimal('20.00')])
+
+            self.assertEqual(SaleLine.search([
+                        ('sale', '=', sale.id),
+                        ('amount', '=', Decimal('0.50')),
+                        ]), [lines[4]])
+            self.assertEqual(SaleLine.search([
+                        ('sale', '=', sale.id),
+                        ('amount', '>', Decimal('3')),
+                        ], order=[('sequence', 'ASC'), ('id', 'ASC')]),
+                [lines[6], lines[7], lines[8]])
+
+    @with_transaction()
+    def test0160update_subtotals_chunks(self):
+        'Test update_subtotals processes the sales by chunks'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            customer, payment_term = self.create_customer(company)
+
+            sales = []
+            for _ in range(3):
+                sale = self.create_sale(company, customer, payment_term)
+                self.create_sale_line(sale, 'title', suffix=' A')
+                self.create_sale_line(sale, 'line')
+                self.create_sale_line(sale, 'title', suffix=' B')
+                self.create_sale_line(sale, 'line')
+                sale.save()
+                sales.append(sale)
+
+            with patch.object(Sale, 'lock', wraps=Sale.lock) as lock:
+                Sale._update_subtotals(sales, chunk_size=2)
+            self.assertEqual(
+                [len(c.args[0]) for c in lock.call_args_list], [2, 1])
+            for sale in Sale.browse(sales):
+                self.assertEqual(
+                    [(l.type, l.description) for l in sale.lines], [
+                        ('title', 'Title line A'),
+                        ('line', 'Normal line'),
+                        ('subtotal', 'Subtotal Title line A'),
+                        ('title', 'Title line B'),
+                        ('line', 'Normal line'),
+                        ('subtotal', 'Subtotal Title line B'),
+                        ])
+
+    @with_transaction()
+    def test0170instrument(self):
+        'Test the instrumented operations add to the counters'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            customer, payment_term = self.create_customer(company)
+
+            sale = self.create_sale(company, customer, payment_term)
+            self.create_sale_line(sale, 'title')
+            self.create_sale_line(sale, 'subtitle')
+            self.create_sale_line(sale, 'line')
+            self.create_sale_line(sale, 'line')
+            sale.save()
+
+            level = instrument_logger.level
+            instrument_logger.setLevel(logging.DEBUG)
+            try:
+                before = deepcopy(dict(counters))
+                Sale.update_subtotals([sale])
+                SaleLine.read(
+                    [l.id for l in Sale(sale.id).lines], ['amount'])
+            finally:
+                instrument_logger.setLevel(level)
+
+            update = counters['update_subtotals']
+            previous = before.get('update_subtotals', {})
+            self.assertEqual(update['calls'], previous.get('calls', 0) + 1)
+            self.assertEqual(update['lines'], previous.get('lines', 0) + 4)
+            self.assertEqual(
+                update['created'], previous.get('created', 0) + 2)
+            self.assertGreater(update['queries'], previous.get('queries', 0))
+            amount = counters['get_amount']
+            previous = before.get('get_amount', {})
+            self.assertGreater(amount['calls'], previous.get('calls', 0))
+            self.assertGreater(amount['lines'], previous.get('lines', 0))
+
+    @with_transaction()
+    def test0180chapters_cache(self):
+        'Test the chapters cache keeps only the last sales used'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        cache = ChaptersCache(2)
+        cache.set(1, 'a')
+        cache.set(2, 'b')
+        self.assertEqual(cache.get(1), 'a')
+        cache.set(3, 'c')
+        self.assertEqual(
+            [cache.get(i) for i in range(1, 4)], ['a', None, 'c'])
+        cache.invalidate([1])
+        self.assertIsNone(cache.get(1))
+
+        company = create_company()
+        with set_company(company):
+            customer, payment_term = self.create_customer(company)
+
+            sales = []
+            for _ in range(3):
+                sale = self.create_sale(company, customer, payment_term)
+                self.create_sale_line(sale, 'title')
+                self.create_sale_line(sale, 'line')
+                sale.save()
+                sales.append(sale)
+
+            with patch.object(ChaptersCache, '_transactions', {}), \
+                    patch('trytond.modules.sale_subchapters.sale.'
+                        'CHAPTERS_CACHE_SIZE', 2):
+                Sale._update_subtotals(sales, chunk_size=1)
+                Sale.get_chapter_summary(sales)
+                self.assertLessEqual(
+                    len(ChaptersCache.get_cache().values), 2)
+
+    @with_transaction()
+    def test0190chapter_tree(self):
+        'Test the chapters relate and the children of the chapter tree'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        ActWindow = pool.get('ir.action.act_window')
+        ModelData = pool.get('ir.model.data')
+
+        company = create_company()
+        with set_company(company):
+            customer, payment_term = self.create_customer(company)
+
+            sale = self.create_sale(company, customer, payment_term)
+            self.create_sale_line(sale, 'line')
+            self.create_sale_line(sale, 'title', suffix=' A')
+            self.create_sale_line(sale, 'subtitle', suffix=' A.1')
+            self.create_sale_line(sale, 'line')
+            self.create_sale_line(sale, 'line')
+            self.create_sale_line(sale, 'title', suffix=' B')
+            self.create_sale_line(sale, 'line')
+            sale.save()
+            other = self.create_sale(company, customer, payment_term)
+            self.create_sale_line(other, 'title')
+            other.save()
+            Sale.update_subtotals([sale])
+            sale = Sale(sale.id)
+
+            action = ActWindow(ModelData.get_id(
+                    'sale_subchapters', 'act_sale_line_chapter'))
+            domain = PYSONDecoder({
+                    'active_id': sale.id,
+                    'active_ids': [sale.id],
+                    }).decode(action.pyson_domain)
+            roots = SaleLine.search(domain, order=[('sequence', 'ASC')])
+            self.assertEqual([(l.type, l.description) for l in roots], [
+                    ('line', 'Normal line'),
+                    ('title', 'Title line A'),
+                    ('title', 'Title line B'),
+                    ])
+
+            title = roots[1]
+            self.assertEqual(
+                [(l.type, l.description) for l in title.chapter_lines], [
+                    ('subtitle', 'Title line A.1'),
+                    ('subtotal', 'Subtotal Title line A'),
+                    ])
+            subtitle, subtotal = title.chapter_lines
+            self.assertEqual(
+                [l.type for l in subtitle.chapter_lines],
+                ['line', 'line', 'subsubtotal'])
+            self.assertEqual(title.chapter_amount, Decimal('20'))
+            # The subtotal adds up the lines since the last subtotal
+            self.assertEqual(subtotal.amount, Decimal('30'))
+    @with_transaction()
+    def test0200cron_sales_domain(self):
+        'Test the cron updates the draft sales of its domain'
+        pool = Pool()
+        Cron = pool.get('ir.cron')
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            customer, payment_term = self.create_customer(company)
+
+            sales = []
+            for reference in ['A', 'B']:
+                sale = self.create_sale(company, customer, payment_term)
+                sale.reference = reference
+                self.create_sale_line(sale, 'title')
+                self.create_sale_line(sale, 'line')
+                sale.save()
+                sales.append(sale)
+
+            cron, = Cron.create([{
+                        'method': 'sale.sale|update_draft_subtotals',
+                        'interval_number': 1,
+                        'interval_type': 'days',
+                        'sale_subtotals_domain': PYSONEncoder().encode(
+                            [('reference', '=', 'B')]),
+                        }])
+            Cron.run_once([cron])
+            self.assertEqual(
+                [[l.type for l in s.lines] for s in Sale.browse(sales)], [
+                    ['title', 'line'],
+                    ['title', 'line', 'subtotal'],
+                    ])
+
+            with self.assertRaises(ValidationError):
+                Cron.write([cron], {
+                        'sale_subtotals_domain': '"reference"',
+                        })
 
 
 del ModuleTestCase